@@ -0,0 +1,166 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+# Per-tool statistics, as output column: (input column, reduction). Rows are
+# per-region (or per-group) summaries, so "mean" is the mean of their averages
+# weighted by num_jobs, not the plain mean of the averages.
+MEM_STATS = {
+    "mem_wastage_min_gb": ("mem_wastage_min_gb", "min"),
+    "avg_tpv_mem_gb": ("avg_tpv_mem_gb", "mean"),
+    "max_tpv_mem_gb": ("max_tpv_mem_gb", "max"),
+    "max_job_max_mem_gb": ("max_job_max_mem_gb", "max"),
+}
+CPU_STATS = {
+    "cpu_wastage_min_seconds": ("cpu_wastage_min_seconds", "min"),
+    "avg_tpv_cores": ("avg_tpv_cores", "mean"),
+    "max_tpv_cores": ("max_tpv_cores", "max"),
+    "avg_allocated_cpu_seconds": ("avg_allocated_cpu_seconds", "mean"),
+    "max_allocated_cpu_seconds": ("max_allocated_cpu_seconds", "max"),
+    "avg_actual_cpu_seconds": ("avg_actual_cpu_seconds", "mean"),
+    "max_actual_cpu_seconds": ("max_actual_cpu_seconds", "max"),
+}
+
+# Leeway given on the minimum wastage before comparing it to the thresholds
+WASTAGE_LEEWAY = 0.95
+MEM_WASTAGE_THRESHOLD_GB = 0.1
+CPU_WASTAGE_THRESHOLD_SECONDS = 120
+
+# Days of job history the statistics cover
+DEFAULT_WINDOW_DAYS = 365
+
+
+def to_float(value):
+    """
+    A tools.yml mem or cores value as a number, NaN when missing or when it is a
+    TPV expression rather than a number.
+    """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class ToolGroups:
+    """
+    Rows of a frame grouped by tool: one stable sort by tool code, after which
+    every statistic is a segment reduction over contiguous arrays.
+    """
+
+    def __init__(self, tool_names, num_jobs):
+        codes, self.tools = pd.factorize(np.asarray(tool_names), sort=True)
+        # Rows without a tool name are dropped, like groupby does
+        self.order = np.flatnonzero(codes >= 0)
+        self.order = self.order[np.argsort(codes[self.order], kind="stable")]
+        sorted_codes = codes[self.order]
+        self.starts = np.flatnonzero(np.diff(sorted_codes, prepend=-1))
+        self.weights = np.asarray(num_jobs, dtype=np.float64)[self.order]
+
+    def __len__(self):
+        return len(self.tools)
+
+    def reduce(self, values, reduction):
+        values = np.asarray(values, dtype=np.float64)[self.order]
+        # fmin/fmax skip NaN, so a tool is only NaN when all of its rows are
+        if reduction == "min":
+            return np.fmin.reduceat(values, self.starts)
+        if reduction == "max":
+            return np.fmax.reduceat(values, self.starts)
+        if reduction == "sum":
+            return np.add.reduceat(np.nan_to_num(values), self.starts)
+        if reduction == "mean":
+            present = ~np.isnan(values)
+            weights = np.where(present, self.weights, 0.0)
+            totals = np.add.reduceat(np.where(present, values * weights, 0.0), self.starts)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return totals / np.add.reduceat(weights, self.starts)
+        raise ValueError(f"Unknown reduction: {reduction}")
+
+
+def weighted_mean(df, column):
+    values = df[column].to_numpy(np.float64)
+    num_jobs = df["num_jobs"].to_numpy(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.nansum(values * num_jobs) / num_jobs.sum()
+
+
+def summarize_tools(combined_df):
+    """
+    Memory and CPU statistics of every tool in ``combined_df``, in one pass.
+    """
+    groups = ToolGroups(combined_df["tpv_tool_name"], combined_df["num_jobs"])
+    columns = {
+        "tpv_tool_name": groups.tools,
+        "num_jobs": groups.reduce(combined_df["num_jobs"], "sum"),
+    }
+    if len(groups):
+        for column, (source, reduction) in {**MEM_STATS, **CPU_STATS}.items():
+            columns[column] = groups.reduce(combined_df[source], reduction)
+    else:
+        columns.update({column: [] for column in {**MEM_STATS, **CPU_STATS}})
+    return pd.DataFrame(columns)
+
+
+def find_wastage(combined_df):
+    """
+    One record per tool with memory wastage over MEM_WASTAGE_THRESHOLD_GB or CPU
+    wastage over CPU_WASTAGE_THRESHOLD_SECONDS. The memory or CPU columns of a tool
+    are NaN when only the other one is over its threshold.
+    """
+    summary = summarize_tools(combined_df)
+
+    summary["mem_wastage_min_gb"] *= WASTAGE_LEEWAY
+    summary["cpu_wastage_min_seconds"] *= WASTAGE_LEEWAY
+    mem_mask = (summary["mem_wastage_min_gb"] > MEM_WASTAGE_THRESHOLD_GB).to_numpy()
+    cpu_mask = (
+        summary["cpu_wastage_min_seconds"] > CPU_WASTAGE_THRESHOLD_SECONDS
+    ).to_numpy()
+
+    summary.loc[~mem_mask, list(MEM_STATS)] = np.nan
+    summary.loc[~cpu_mask, list(CPU_STATS)] = np.nan
+    return summary[mem_mask | cpu_mask].reset_index(drop=True)
+
+
+# Breakdowns of the per-tool statistics, as tagged by mem-optimize.py's
+# SQL_BREAKDOWN_QUERY_TEMPLATE
+BREAKDOWNS = ["tool_version", "destination", "cores"]
+BREAKDOWN_KEY_SEPARATOR = "\x1f"
+
+
+def find_breakdown_wastage(breakdown_df):
+    """
+    find_wastage for every breakdown value of every tool, e.g. each version of a
+    tool, from rows tagged with their ``breakdown`` and ``value``. The result has
+    breakdown, tpv_tool_name and value (None when not known) before the usual
+    columns.
+    """
+    frames = []
+    for breakdown in BREAKDOWNS:
+        rows = breakdown_df[
+            (breakdown_df["breakdown"] == breakdown).to_numpy()
+            & breakdown_df["tpv_tool_name"].notna().to_numpy()
+        ]
+        if not len(rows):
+            continue
+        values = rows["value"].astype(object)
+        # Group on tool and value together, keeping apart values that are missing
+        keys = (
+            rows["tpv_tool_name"].astype(str)
+            + BREAKDOWN_KEY_SEPARATOR
+            + values.where(values.notna(), "").astype(str)
+            + np.where(values.notna(), "", BREAKDOWN_KEY_SEPARATOR)
+        )
+        summary = find_wastage(rows.assign(tpv_tool_name=keys.to_numpy()))
+        parts = summary["tpv_tool_name"].str.split(BREAKDOWN_KEY_SEPARATOR, regex=False)
+        summary.insert(0, "breakdown", breakdown)
+        summary["tpv_tool_name"] = parts.str[0]
+        summary.insert(
+            2, "value", [part[1] if len(part) == 2 else None for part in parts]
+        )
+        frames.append(summary)
+    if not frames:
+        return pd.DataFrame(
+            columns=["breakdown", "tpv_tool_name", "value", "num_jobs", *MEM_STATS, *CPU_STATS]
+        )
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,41 @@
+import os
+import tempfile
+
+# Files written by mkstemp are private, new files get the usual permissions instead
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def replace_file(file_path, write):
+    """
+    Replace ``file_path`` with what ``write`` writes to the temporary path it is
+    passed, so that readers see either the old or the new file, never a partial
+    one. The temporary file is unique, so concurrent writers never clash.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(file_path)}.", suffix=".tmp"
+    )
+    os.close(fd)
+    try:
+        write(tmp_path)
+        with open(tmp_path, "rb") as file:
+            os.fsync(file.fileno())
+        if os.path.exists(file_path):
+            os.chmod(tmp_path, os.stat(file_path).st_mode & 0o7777)
+        else:
+            os.chmod(tmp_path, 0o666 & ~UMASK)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_text(file_path, text):
+    # Line endings are written as they are in ``text``
+    def write(path):
+        with open(path, "w", newline="") as file:
+            file.write(text)
+
+    replace_file(file_path, write)
@@ -0,0 +1,347 @@
+import argparse
+import asyncio
+import copy
+import importlib.util
+import json
+import logging
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest.mock
+
+import numpy as np
+import pandas as pd
+
+import aggregation
+import db
+import interchange
+import replay
+import synthetic
+import tool_matching
+import yaml_io
+
+# Configure logging to print to stdout
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# Create a stream handler to print to stdout
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+
+# Create a formatter and set it for the handler
+formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+
+# Add the handler to the logger
+log.addHandler(handler)
+
+# Benchmarks of each step of mem-optimize.py and update-shared-db.py on synthetic
+# data (see synthetic.py). At scale 1 the federation has BASE_TOOLS tools that ran
+# BASE_JOBS jobs over three regions, and a tools.yml with BASE_EXTRA_TOOLS entries
+# for tools that never ran; every scale multiplies all three.
+BASE_TOOLS = 1000
+BASE_JOBS = 100_000
+BASE_EXTRA_TOOLS = 1000
+
+DEFAULT_SCALES = [1, 10, 100]
+DEFAULT_REPEAT = 3
+# Short benchmarks are repeated until they ran this long in total, to even out noise
+MIN_SECONDS = 1.0
+MAX_RUNS = 200
+DEFAULT_BASELINE = "benchmark-baseline.json"
+DEFAULT_MAX_SLOWDOWN = 1.25
+
+# Columns of the job-level rows replay.py streams
+DECODE_COLUMNS = ["tpv_tool_name", *replay.JOB_COLUMNS]
+# Distinct chunks a decode streams over and over, to keep the input small
+DECODE_DISTINCT_CHUNKS = 8
+
+
+def load_script(name, file_name):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+mem_optimize = load_script("mem_optimize", "mem-optimize.py")
+update_shared_db = load_script("update_shared_db", "update-shared-db.py")
+# Per-query and per-tool messages would drown the report
+mem_optimize.log.setLevel(logging.ERROR)
+update_shared_db.log.setLevel(logging.ERROR)
+
+
+class Data:
+    """
+    Everything the benchmarks of one scale work on, generated up front so that
+    generating it isn't measured.
+    """
+
+    def __init__(self, scale, tmp_dir):
+        self.scale = scale
+        self.tmp_dir = tmp_dir
+        usage = synthetic.federation(BASE_TOOLS * scale, BASE_JOBS * scale)
+        self.frames = synthetic.resource_frames(usage)
+        self.combined_df = pd.concat(self.frames)
+        self.wastage_df = aggregation.find_wastage(self.combined_df)
+        self.tools = self.wastage_df["tpv_tool_name"].tolist()
+        self.wastage = update_shared_db.wastage_columns(
+            interchange.to_records(self.wastage_df)
+        )
+
+        # Rows of the first region as asyncpg hands them over
+        first = next(iter(usage.values()))
+        self.num_job_rows = len(first)
+        rows = first[DECODE_COLUMNS].head(db.FETCH_CHUNK_SIZE * DECODE_DISTINCT_CHUNKS)
+        rows = list(rows.itertuples(index=False, name=None))
+        self.decode_chunks = [
+            rows[start : start + db.FETCH_CHUNK_SIZE]
+            for start in range(0, len(rows), db.FETCH_CHUNK_SIZE)
+        ]
+
+        self.shared_db = synthetic.shared_db(
+            [name for frame in self.frames for name in frame["tpv_tool_name"]],
+            BASE_EXTRA_TOOLS * scale,
+        )
+        self.tools_yml = os.path.join(tmp_dir, f"tools-{scale}.yml")
+        yaml_io.dump(self.shared_db, self.tools_yml)
+
+
+async def stand_in_stream(chunks, num_rows):
+    """
+    Stand-in for db.stream_data: the column names, then ``num_rows`` rows in
+    chunks, cycling through ``chunks``.
+    """
+    yield DECODE_COLUMNS
+    sent = 0
+    while sent < num_rows:
+        for chunk in chunks:
+            if sent >= num_rows:
+                break
+            chunk = chunk[: num_rows - sent]
+            sent += len(chunk)
+            yield chunk
+
+
+def bench_decode(data):
+    def stream_data(engine, query, chunk_size=db.FETCH_CHUNK_SIZE):
+        return stand_in_stream(data.decode_chunks, data.num_job_rows)
+
+    def run(_):
+        with unittest.mock.patch.object(db, "stream_data", stream_data):
+            asyncio.run(mem_optimize.fetch_data(None, None))
+
+    return None, run, data.num_job_rows
+
+
+def bench_wastage(data):
+    return None, lambda _: aggregation.find_wastage(data.combined_df), len(data.combined_df)
+
+
+def bench_export(data):
+    path = os.path.join(data.tmp_dir, "output.arrow")
+
+    def run(_):
+        interchange.write(path, data.wastage_df, {"window": 365})
+        table, _ = interchange.read(path)
+        interchange.to_records(table.to_pandas())
+
+    return None, run, len(data.wastage_df)
+
+
+def bench_match(data):
+    def run(_):
+        matcher = tool_matching.ToolMatcher(data.shared_db["tools"])
+        for tool in data.tools:
+            update_shared_db.find_matching_tool_in_shared_db(tool, matcher)
+
+    return None, run, len(data.tools)
+
+
+def bench_adjust(data):
+    def setup():
+        return copy.deepcopy(data.shared_db)
+
+    def run(shared_db):
+        update_shared_db.adjust_resources(shared_db, data.tools, data.wastage)
+
+    return setup, run, len(data.tools)
+
+
+def bench_yaml_load(data):
+    return None, lambda _: yaml_io.Document(data.tools_yml), len(data.shared_db["tools"])
+
+
+def bench_yaml_save(data):
+    path = os.path.join(data.tmp_dir, "saved.yml")
+
+    def setup():
+        document = yaml_io.Document(data.tools_yml)
+        update_shared_db.adjust_resources(document.data, data.tools, data.wastage)
+        return document
+
+    return setup, lambda document: document.save(path), len(data.shared_db["tools"])
+
+
+# Name: (what it measures, function returning setup, run and items processed)
+BENCHMARKS = {
+    "decode": ("fetch_data decoding of job-level rows", bench_decode),
+    "wastage": ("aggregation.find_wastage over per-region rows", bench_wastage),
+    "export": ("interchange write, read and to_records of the wastage data", bench_export),
+    "match": ("ToolMatcher build and a lookup per tool", bench_match),
+    "adjust": ("adjust_resources on a copy of tools.yml", bench_adjust),
+    "yaml_load": ("yaml_io.Document load of tools.yml", bench_yaml_load),
+    "yaml_save": ("patching save of the adjusted tools.yml", bench_yaml_save),
+}
+
+
+def measure(setup, run, repeat):
+    """
+    Best of at least ``repeat`` timed runs, and the peak of Python-allocated
+    memory (incl. NumPy and pandas buffers) during one more, traced, run.
+    """
+    best = math.inf
+    total = 0.0
+    runs = 0
+    while runs < repeat or (total < MIN_SECONDS and runs < MAX_RUNS):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        run(state)
+        seconds = time.perf_counter() - start
+        best = min(best, seconds)
+        total += seconds
+        runs += 1
+    state = setup() if setup else None
+    tracemalloc.start()
+    try:
+        run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak
+
+
+def run_benchmarks(scales, names, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="tpv-db-optimizer-bench-") as tmp_dir:
+        for scale in scales:
+            start = time.perf_counter()
+            data = Data(scale, tmp_dir)
+            log.debug(f"Generated data for scale {scale}x in {time.perf_counter() - start:.1f}s")
+            for name in names:
+                setup, run, items = BENCHMARKS[name][1](data)
+                seconds, peak = measure(setup, run, repeat)
+                results[f"{name}@{scale}x"] = {
+                    "items": items,
+                    "seconds": seconds,
+                    "items_per_second": items / seconds if seconds else math.inf,
+                    "peak_mb": peak / 1024**2,
+                }
+                log.debug(f"{name}@{scale}x: {seconds:.4f}s")
+    return results
+
+
+def report(results, baseline, max_slowdown):
+    """
+    Print the results next to the baseline. Returns the benchmarks that got more
+    than ``max_slowdown`` times slower.
+    """
+    regressions = []
+    print(
+        f"{'benchmark':<16} {'items':>10} {'seconds':>10} {'items/s':>12} {'peak MB':>9} {'vs baseline':>12}"
+    )
+    for key, result in results.items():
+        compared = ""
+        if key in baseline:
+            ratio = result["seconds"] / baseline[key]["seconds"]
+            compared = f"x{ratio:.2f}"
+            if ratio > max_slowdown:
+                compared += " !"
+                regressions.append(key)
+        print(
+            f"{key:<16} {result['items']:>10} {result['seconds']:>10.4f} "
+            f"{result['items_per_second']:>12.0f} {result['peak_mb']:>9.1f} {compared:>12}"
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark mem-optimize.py and update-shared-db.py on synthetic data.",
+        epilog="benchmarks: "
+        + "; ".join(f"{name}: {description}" for name, (description, _) in BENCHMARKS.items()),
+    )
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help=f"Benchmarks to run, all by default: {', '.join(BENCHMARKS)}",
+    )
+    parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=DEFAULT_SCALES,
+        help=f"Scales to run at, multiplying {BASE_TOOLS} tools and {BASE_JOBS} jobs",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        help="Timed runs per benchmark, the fastest counts",
+    )
+    parser.add_argument(
+        "--baseline",
+        default=DEFAULT_BASELINE,
+        help="Results to compare against, as written by --save-baseline",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store the results as the new baseline",
+    )
+    parser.add_argument(
+        "--max-slowdown",
+        type=float,
+        default=DEFAULT_MAX_SLOWDOWN,
+        help="Exit with status 1 when a benchmark takes more than this many times its baseline",
+    )
+    parser.add_argument(
+        "--output",
+        help="Also write the results to this JSON file",
+    )
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    results = run_benchmarks(args.scales, args.benchmarks or list(BENCHMARKS), args.repeat)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+    regressions = report(results, baseline, args.max_slowdown)
+
+    document = {
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(document, file, indent=2)
+    if args.save_baseline:
+        if baseline:
+            # Keep the baseline of benchmarks and scales that weren't run
+            document["results"] = {**baseline, **results}
+        with open(args.baseline, "w") as file:
+            json.dump(document, file, indent=2)
+        log.debug(f"Baseline written to {args.baseline}")
+    if regressions:
+        log.error(f"Slower than {args.max_slowdown}x the baseline: {', '.join(regressions)}")
+        sys.exit(1)
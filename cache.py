@@ -0,0 +1,73 @@
+import hashlib
+import logging
+import os
+import time
+
+import pandas as pd
+
+import atomic_file
+from registry import redact
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "tpv-db-optimizer",
+)
+# Hours
+DEFAULT_TTL = 24
+# Megabytes
+DEFAULT_MAX_SIZE = 1024
+
+
+def cache_key(uri, region, query, window_end):
+    """
+    Key for one region's query result. Passwords are left out of the key, and the
+    date the window ends on is part of it so that results roll over daily.
+    """
+    digest = hashlib.sha256(
+        "\0".join([redact(uri), region, query, str(window_end)]).encode("utf-8")
+    ).hexdigest()
+    return f"{region}-{digest[:32]}"
+
+
+def cache_path(cache_dir, key):
+    return os.path.join(cache_dir, f"{key}.parquet")
+
+
+def load(cache_dir, key, ttl):
+    path = cache_path(cache_dir, key)
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+    if age > ttl * 3600:
+        log.debug(f"Cached result {key} expired")
+        return None
+    return pd.read_parquet(path)
+
+
+def store(cache_dir, key, df, max_size=DEFAULT_MAX_SIZE):
+    os.makedirs(cache_dir, exist_ok=True)
+    path = cache_path(cache_dir, key)
+    atomic_file.replace_file(path, lambda tmp_path: df.to_parquet(tmp_path, index=False))
+    evict(cache_dir, max_size)
+
+
+def evict(cache_dir, max_size):
+    """
+    Remove the least recently written results until the cache fits in ``max_size``
+    megabytes.
+    """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".parquet"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size * 1024 * 1024:
+            break
+        os.remove(path)
+        total -= size
+        log.debug(f"Evicted cached result: {path}")
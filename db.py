@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import event, text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import metrics
+
+# Rows held in memory at a time while streaming a result
+FETCH_CHUNK_SIZE = 10000
+
+
+class ColumnarBuilder:
+    """
+    Accumulates streamed result rows chunk by chunk into typed column arrays:
+    float64 for numeric columns and categorical codes for text columns.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.chunks = {column: [] for column in self.columns}
+        # Code per distinct value of each text column
+        self.categories = {}
+        self.numeric = set()
+        self.num_rows = 0
+
+    def append(self, rows):
+        if not rows:
+            return
+        for column, values in zip(self.columns, zip(*rows)):
+            if column not in self.categories and column not in self.numeric:
+                first = next((v for v in values if v is not None), None)
+                if first is None:
+                    # Type unknown until a non-null value shows up
+                    self.chunks[column].append(len(values))
+                    continue
+                if isinstance(first, str):
+                    self.categories[column] = {}
+                else:
+                    self.numeric.add(column)
+            if column in self.categories:
+                lookup = self.categories[column]
+                codes = np.fromiter(
+                    (
+                        -1 if v is None else lookup.setdefault(v, len(lookup))
+                        for v in values
+                    ),
+                    dtype=np.int32,
+                    count=len(values),
+                )
+                self.chunks[column].append(codes)
+            else:
+                self.chunks[column].append(np.array(values, dtype=np.float64))
+        self.num_rows += len(rows)
+
+    def to_frame(self):
+        data = {}
+        for column in self.columns:
+            is_category = column in self.categories
+            fill = -1 if is_category else np.nan
+            dtype = np.int32 if is_category else np.float64
+            arrays = [
+                np.full(chunk, fill, dtype=dtype) if isinstance(chunk, int) else chunk
+                for chunk in self.chunks[column]
+            ]
+            values = np.concatenate(arrays) if arrays else np.empty(0, dtype=dtype)
+            if is_category:
+                values = pd.Categorical.from_codes(
+                    values, categories=list(self.categories[column])
+                )
+            data[column] = values
+        return pd.DataFrame(data, columns=self.columns)
+
+
+def decode_numeric_as_float(engine):
+    """
+    Have asyncpg decode Postgres numeric straight to float instead of Decimal.
+    """
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def register_codec(dbapi_connection, connection_record):
+        dbapi_connection.run_async(
+            lambda connection: connection.set_type_codec(
+                "numeric",
+                encoder=str,
+                decoder=float,
+                schema="pg_catalog",
+                format="text",
+            )
+        )
+
+    return engine
+
+
+async def stream_data(engine, query, chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Run ``query`` with a server-side cursor, yielding the column names and then
+    lists of at most ``chunk_size`` rows.
+    """
+    with metrics.stage("connect"):
+        connection = await engine.connect()
+    try:
+        result = await connection.stream(text(query))
+        yield list(result.keys())
+        async for partition in result.partitions(chunk_size):
+            yield partition
+    finally:
+        await connection.close()
+
+
+async def fetch_frame(connection, query, parameters=None, chunk_size=FETCH_CHUNK_SIZE):
+    """
+    Stream the result of ``query`` on an open connection into a DataFrame, in the
+    caller's transaction.
+    """
+    result = await connection.stream(text(query), parameters or {})
+    builder = ColumnarBuilder(result.keys())
+    async for partition in result.partitions(chunk_size):
+        builder.append(partition)
+    return builder.to_frame()
+
+
+def create_engine(database, echo=False):
+    server_settings = {}
+    if database["statement_timeout"] is not None:
+        server_settings["statement_timeout"] = str(
+            int(database["statement_timeout"] * 1000)
+        )
+    return decode_numeric_as_float(
+        create_async_engine(
+            database["uri"],
+            echo=echo,
+            pool_size=database["pool_size"],
+            max_overflow=0,
+            connect_args={"server_settings": server_settings},
+        )
+    )
@@ -0,0 +1,88 @@
+import datetime
+import json
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.ipc
+
+import atomic_file
+
+# Per-tool wastage records handed from mem-optimize.py to update-shared-db.py, as
+# an uncompressed Arrow IPC file so that readers can memory-map it. Missing values
+# are nulls. Bump SCHEMA_VERSION on any incompatible change to the columns.
+SCHEMA_VERSION = 1
+METADATA_KEY = b"tpv_db_optimizer"
+
+TOOL_COLUMN = "tpv_tool_name"
+# Labels of the per-breakdown records, see aggregation.find_breakdown_wastage
+STRING_COLUMNS = {"breakdown", "value"}
+
+
+def schema(columns, metadata):
+    fields = []
+    for column in columns:
+        if column == TOOL_COLUMN:
+            fields.append(pa.field(column, pa.string(), nullable=False))
+        elif column in STRING_COLUMNS:
+            fields.append(pa.field(column, pa.string()))
+        elif column == "num_jobs":
+            fields.append(pa.field(column, pa.int64()))
+        else:
+            fields.append(pa.field(column, pa.float64()))
+    metadata = {
+        "schema_version": SCHEMA_VERSION,
+        "generated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        **metadata,
+    }
+    return pa.schema(fields, metadata={METADATA_KEY: json.dumps(metadata)})
+
+
+def write(file_path, df, metadata):
+    """
+    Write the per-tool records in ``df`` to ``file_path``, with ``metadata``
+    (window, regions, thresholds, ...) stored in the schema.
+    """
+    table_schema = schema(df.columns, metadata)
+    table = pa.Table.from_pandas(
+        df, schema=table_schema, preserve_index=False
+    ).replace_schema_metadata(table_schema.metadata)
+
+    def write_table(path):
+        with pa.OSFile(path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    atomic_file.replace_file(file_path, write_table)
+
+
+def read(file_path):
+    """
+    Memory-map a file written by ``write``. Returns the table and its metadata.
+    """
+    table = pa.ipc.open_file(pa.memory_map(file_path, "r")).read_all()
+    metadata = json.loads((table.schema.metadata or {}).get(METADATA_KEY, b"{}"))
+    version = metadata.get("schema_version")
+    if version != SCHEMA_VERSION:
+        raise ValueError(
+            f"{file_path} has schema version {version}, expected {SCHEMA_VERSION}"
+        )
+    return table, metadata
+
+
+def float_column(table, column):
+    """
+    A column as float64, with NaN for nulls. Zero-copy when it has no nulls.
+    """
+    if column not in table.column_names:
+        return np.full(table.num_rows, np.nan)
+    values = table.column(column).combine_chunks().cast(pa.float64())
+    if values.null_count:
+        values = values.fill_null(np.nan)
+    return values.to_numpy(zero_copy_only=False)
+
+
+def to_records(df):
+    """
+    The per-tool records as a dict by tool, for the YAML export.
+    """
+    return df.set_index(TOOL_COLUMN).to_dict("index")
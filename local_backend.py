@@ -0,0 +1,326 @@
+import datetime
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+import sketches
+from views import REGIONS, USAGE_START
+
+log = logging.getLogger(__name__)
+
+# Local stand-in for the Postgres side of mem-optimize.py: computes the per-job
+# usage of views.py and the per-tool aggregates of SQL_RESOURCE_QUERY_COMMON from
+# exported job and job_metric_numeric tables, with vectorized pandas/NumPy.
+#
+# A dump directory holds <region>_job and <region>_job_metric_numeric tables as
+# .parquet or .csv files, e.g. exported with
+#   \copy (SELECT id, update_time, tool_id, state, destination_id, destination_params FROM au_job) TO 'au_job.csv' CSV HEADER
+#   \copy (SELECT job_id, metric_name, metric_value FROM au_job_metric_numeric) TO 'au_job_metric_numeric.csv' CSV HEADER
+
+TOOL_ID_PATTERN = r"(toolshed.g2.bx.psu.edu/repos/.*/.*/(.*))/.*"
+
+# Column order of SQL_RESOURCE_QUERY_COMMON
+RESOURCE_COLUMNS = [
+    "tpv_tool_name",
+    "num_jobs",
+    "avg_tpv_mem_gb",
+    "max_tpv_mem_gb",
+    "avg_tpv_cores",
+    "max_tpv_cores",
+    "avg_job_max_mem_gb",
+    "max_job_max_mem_gb",
+    "mem_wastage_avg_gb",
+    "mem_wastage_min_gb",
+    "mem_wastage_avg_percentage",
+    "mem_wastage_min_percentage",
+    "avg_allocated_cpu_seconds",
+    "max_allocated_cpu_seconds",
+    "avg_actual_cpu_seconds",
+    "max_actual_cpu_seconds",
+    "cpu_wastage_avg_seconds",
+    "cpu_wastage_min_seconds",
+    "cpu_wastage_avg_percentage",
+    "cpu_wastage_min_percentage",
+]
+
+
+def find_table(dump_dir, name):
+    for extension in (".parquet", ".csv"):
+        path = os.path.join(dump_dir, name + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load_table(path, columns=None):
+    if path.endswith(".parquet"):
+        return pd.read_parquet(path, columns=columns)
+    return pd.read_csv(path, usecols=columns)
+
+
+def decode_params(params):
+    """
+    destination_params as text, whether exported as raw bytes or as Postgres'
+    hex bytea format.
+    """
+
+    def decode(value):
+        if isinstance(value, (bytes, bytearray)):
+            return value.decode("utf-8", errors="replace")
+        if isinstance(value, str) and value.startswith("\\x"):
+            return bytes.fromhex(value[2:]).decode("utf-8", errors="replace")
+        return value
+
+    return params.map(decode, na_action="ignore").astype("string")
+
+
+def extract_number(text, pattern):
+    return pd.to_numeric(text.str.extract(pattern, expand=False), errors="coerce")
+
+
+def parse_allocations(params, params_format):
+    """
+    Return (tpv_cores, tpv_mem_gb) arrays, as extracted by the region's SQL.
+    """
+    if params_format == "json":
+        cores = extract_number(params, r'"tpv_cores"\s*:\s*"?(-?[\d.]+)')
+        mem = extract_number(params, r'"tpv_mem"\s*:\s*"?(-?[\d.]+)')
+    else:
+        cores = extract_number(params, r"ntasks=(\d+)")
+        mem_per_cpu = extract_number(params, r"mem-per-cpu=(\d+)")
+        # Fallback to regular mem if mem-per-cpu is not found
+        mem = (mem_per_cpu * cores).fillna(extract_number(params, r"mem=(\d+)")) / 1024.0
+    return cores.to_numpy(np.float64), mem.to_numpy(np.float64)
+
+
+def job_usage(region, jobs, metrics):
+    """
+    Per-job usage rows of a region, matching the *_job_resource_usage_view columns.
+    """
+    config = REGIONS[region]
+    jobs = jobs[
+        (jobs["state"] == "ok")
+        & (pd.to_datetime(jobs["update_time"]) > pd.Timestamp(USAGE_START))
+    ]
+    prefix = config["excluded_destination_prefix"]
+    if prefix:
+        jobs = jobs[~jobs["destination_id"].fillna("").str.startswith(prefix)]
+
+    # Pivot the metrics we need into one column each, in one pass
+    names = {
+        config["mem_metric"]: "mem_bytes",
+        config["runtime_metric"]: "runtime",
+        config["cpu_metric"]: "cpu_usage",
+    }
+    metrics = metrics[metrics["metric_name"].isin(list(names))]
+    pivot = (
+        metrics.assign(metric_value=pd.to_numeric(metrics["metric_value"]))
+        .groupby(["job_id", "metric_name"])["metric_value"]
+        .max()
+        .unstack("metric_name")
+        .rename(columns=names)
+        .reindex(columns=list(names.values()))
+    )
+    usage = jobs.join(pivot, on="id", how="inner")
+    usage = usage[usage["mem_bytes"].notna()]
+
+    tool_parts = usage["tool_id"].astype("string").str.extract(TOOL_ID_PATTERN)
+    tpv_cores, tpv_mem_gb = parse_allocations(
+        decode_params(usage["destination_params"]), config["params_format"]
+    )
+    runtime = usage["runtime"].to_numpy(np.float64)
+    result = pd.DataFrame(
+        {
+            "job_id": usage["id"].to_numpy(),
+            "updated": pd.to_datetime(usage["update_time"]).to_numpy(),
+            "tool_id": usage["tool_id"].to_numpy(),
+            "tool_name": tool_parts[1].fillna(usage["tool_id"]).to_numpy(),
+            "tpv_tool_name": tool_parts[0].fillna(usage["tool_id"]).to_numpy(),
+            "tpv_cores": tpv_cores,
+            "tpv_mem_gb": tpv_mem_gb,
+            "job_max_mem_gb": usage["mem_bytes"].to_numpy(np.float64) / 1024**3,
+            "runtime_seconds": runtime,
+            "actual_cpu_seconds": usage["cpu_usage"].to_numpy(np.float64)
+            / float(config["cpu_metric_divisor"]),
+            "allocated_cpu_seconds": tpv_cores * runtime,
+            "destination": usage["destination_id"].to_numpy(),
+        }
+    )
+    if config["requires_tpv_cores"]:
+        result = result[result["tpv_cores"].notna()].reset_index(drop=True)
+    return result
+
+
+def in_window(usage, window, window_end=None):
+    window_end = window_end or datetime.date.today()
+    start = pd.Timestamp(window_end - datetime.timedelta(days=int(window)))
+    return usage[usage["updated"] >= start]
+
+
+def resource_aggregates(usage, keys=("tpv_tool_name", "tool_name"), dropna=True):
+    """
+    Per-tool aggregates with the same columns as SQL_RESOURCE_QUERY_COMMON, or
+    grouped by ``keys`` instead, which are then kept as leading columns.
+    """
+    # GREATEST ignores nulls, so missing allocations count as no wastage
+    mem_wastage = np.fmax(usage["tpv_mem_gb"] - usage["job_max_mem_gb"], 0)
+    cpu_wastage = np.fmax(
+        usage["allocated_cpu_seconds"] - usage["actual_cpu_seconds"], 0
+    )
+    frame = usage.assign(
+        mem_wastage=mem_wastage,
+        mem_wastage_percentage=mem_wastage / usage["tpv_mem_gb"].replace(0, np.nan) * 100,
+        cpu_wastage=cpu_wastage,
+        cpu_wastage_percentage=cpu_wastage
+        / usage["allocated_cpu_seconds"].replace(0, np.nan)
+        * 100,
+    )
+    result = frame.groupby(list(keys), as_index=False, sort=False, dropna=dropna).agg(
+        num_jobs=("job_id", "size"),
+        avg_tpv_mem_gb=("tpv_mem_gb", "mean"),
+        max_tpv_mem_gb=("tpv_mem_gb", "max"),
+        avg_tpv_cores=("tpv_cores", "mean"),
+        max_tpv_cores=("tpv_cores", "max"),
+        avg_job_max_mem_gb=("job_max_mem_gb", "mean"),
+        max_job_max_mem_gb=("job_max_mem_gb", "max"),
+        mem_wastage_avg_gb=("mem_wastage", "mean"),
+        mem_wastage_min_gb=("mem_wastage", "min"),
+        mem_wastage_avg_percentage=("mem_wastage_percentage", "mean"),
+        mem_wastage_min_percentage=("mem_wastage_percentage", "min"),
+        avg_allocated_cpu_seconds=("allocated_cpu_seconds", "mean"),
+        max_allocated_cpu_seconds=("allocated_cpu_seconds", "max"),
+        avg_actual_cpu_seconds=("actual_cpu_seconds", "mean"),
+        max_actual_cpu_seconds=("actual_cpu_seconds", "max"),
+        cpu_wastage_avg_seconds=("cpu_wastage", "mean"),
+        cpu_wastage_min_seconds=("cpu_wastage", "min"),
+        cpu_wastage_avg_percentage=("cpu_wastage_percentage", "mean"),
+        cpu_wastage_min_percentage=("cpu_wastage_percentage", "min"),
+    )
+    for column in [
+        "mem_wastage_avg_percentage",
+        "mem_wastage_min_percentage",
+        "cpu_wastage_avg_percentage",
+        "cpu_wastage_min_percentage",
+    ]:
+        result[column] = result[column].fillna(0)
+    result["num_jobs"] = result["num_jobs"].astype(np.float64)
+    # Resource columns not grouped on, like tool_name, are left null
+    columns = [key for key in keys if key not in RESOURCE_COLUMNS] + RESOURCE_COLUMNS
+    return (
+        result.sort_values("num_jobs", kind="stable")
+        .reindex(columns=columns)
+        .reset_index(drop=True)
+    )
+
+
+def breakdown_aggregates(usage):
+    """
+    Rows of mem-optimize.py's SQL_BREAKDOWN_QUERY_TEMPLATE: the aggregates per
+    tool, and per tool version, destination and core count of each tool.
+    """
+    # The version is what follows the tpv tool name in the tool id
+    versions = [
+        tool_id[len(name) + 1 :] or None
+        if isinstance(tool_id, str) and isinstance(name, str)
+        else None
+        for tool_id, name in zip(usage["tool_id"], usage["tpv_tool_name"])
+    ]
+    cores = [None if pd.isna(value) else f"{value:g}" for value in usage["tpv_cores"]]
+    usage = usage.assign(
+        tool_version=pd.Series(versions, index=usage.index, dtype=object),
+        destination=usage["destination"].astype(object),
+        cores=pd.Series(cores, index=usage.index, dtype=object),
+    )
+    frames = [resource_aggregates(usage).assign(breakdown="tool", value=None)]
+    for breakdown in ["tool_version", "destination", "cores"]:
+        # Like GROUP BY, which keeps jobs without a version, destination or cores
+        frame = resource_aggregates(usage, ("tpv_tool_name", breakdown), dropna=False)
+        frames.append(frame.rename(columns={breakdown: "value"}).assign(breakdown=breakdown))
+    result = pd.concat(frames, ignore_index=True)
+    return result[["breakdown", "value"] + RESOURCE_COLUMNS]
+
+
+def metric_values(usage):
+    """
+    Per-job values of sketches.SKETCH_METRICS, which raw mode keeps as well.
+    """
+    return {
+        "job_max_mem_gb": usage["job_max_mem_gb"],
+        "cpu_fraction": usage["actual_cpu_seconds"]
+        / usage["allocated_cpu_seconds"].replace(0, np.nan),
+        "runtime_seconds": usage["runtime_seconds"],
+    }
+
+
+def sketch_counts(usage):
+    """
+    Per-tool histogram bucket counts, as returned by the sketch queries.
+    """
+    values = metric_values(usage)
+    frames = []
+    for metric in sketches.SKETCH_METRICS:
+        series = values[metric]
+        present = series.notna().to_numpy()
+        frames.append(
+            pd.DataFrame(
+                {
+                    "tpv_tool_name": usage["tpv_tool_name"].to_numpy()[present],
+                    "metric": metric,
+                    "bucket": sketches.to_buckets(series.to_numpy()[present]),
+                }
+            )
+        )
+    counts = (
+        pd.concat(frames)
+        .groupby(["tpv_tool_name", "metric", "bucket"], as_index=False)
+        .size()
+    )
+    return counts.rename(columns={"size": "count"})
+
+
+def load_usage(dump_dir, region):
+    jobs_path = find_table(dump_dir, f"{region}_job")
+    metrics_path = find_table(dump_dir, f"{region}_job_metric_numeric")
+    if not jobs_path or not metrics_path:
+        return None
+    jobs = load_table(
+        jobs_path,
+        ["id", "update_time", "tool_id", "state", "destination_id", "destination_params"],
+    )
+    metrics = load_table(metrics_path, ["job_id", "metric_name", "metric_value"])
+    log.debug(f"Loaded {len(jobs)} jobs and {len(metrics)} metrics for region: {region}")
+    return job_usage(region, jobs, metrics)
+
+
+def dump_regions(dump_dir):
+    return [
+        region
+        for region in REGIONS
+        if find_table(dump_dir, f"{region}_job")
+        and find_table(dump_dir, f"{region}_job_metric_numeric")
+    ]
+
+
+def compute_all_data(
+    dump_dir, window, percentiles=(), window_end=None, raw_store=None, breakdowns=False
+):
+    """
+    Same results as mem-optimize.py's fetch_all_data, computed from the dumps in
+    ``dump_dir`` for every region that has one.
+    """
+    results = {}
+    for region in dump_regions(dump_dir):
+        usage = in_window(load_usage(dump_dir, region), window, window_end)
+        aggregates = breakdown_aggregates if breakdowns else resource_aggregates
+        results.setdefault("resource", []).append(aggregates(usage))
+        if percentiles and raw_store is not None:
+            raw_store.append(
+                raw_store.new_source(), usage["tpv_tool_name"], metric_values(usage)
+            )
+        elif percentiles:
+            results.setdefault("sketch", []).append(sketch_counts(usage))
+    if not results:
+        raise FileNotFoundError(f"No region dumps found in: {dump_dir}")
+    return results
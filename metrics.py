@@ -0,0 +1,138 @@
+import contextlib
+import contextvars
+import datetime
+import json
+import time
+
+import atomic_file
+
+# Stage timers and counters of the mem-optimize.py -> update-shared-db.py
+# pipeline. Every event is appended to a JSON lines file as it happens, and the
+# totals can be written as an OpenMetrics text file, e.g. for node_exporter's
+# textfile collector. Labels set by an enclosing stage (like the region of a
+# query) are added to everything recorded within it, also across awaits.
+PREFIX = "tpv_db_optimizer"
+
+labels_in_context = contextvars.ContextVar("labels", default={})
+
+
+class Metrics:
+    def __init__(self):
+        self.jsonl_file = None
+        # (name, labels) -> total
+        self.counters = {}
+        # (name, labels) -> [count, total seconds]
+        self.timers = {}
+
+    def configure(self, jsonl_path=None):
+        self.close()
+        if jsonl_path:
+            self.jsonl_file = open(jsonl_path, "a", buffering=1)
+
+    def close(self):
+        if self.jsonl_file is not None:
+            self.jsonl_file.close()
+            self.jsonl_file = None
+
+    def emit(self, event):
+        if self.jsonl_file is not None:
+            event = {
+                "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                **event,
+            }
+            self.jsonl_file.write(json.dumps(event, default=str) + "\n")
+
+    def observe(self, stage, seconds, **labels):
+        labels = {**labels_in_context.get(), **labels}
+        key = (stage, tuple(sorted(labels.items())))
+        timer = self.timers.setdefault(key, [0, 0.0])
+        timer[0] += 1
+        timer[1] += seconds
+        self.emit({"stage": stage, "seconds": seconds, "labels": labels})
+
+    def count(self, name, value=1, **labels):
+        labels = {**labels_in_context.get(), **labels}
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+        self.emit({"counter": name, "value": value, "labels": labels})
+
+    @contextlib.contextmanager
+    def stage(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            with self.labels(**labels):
+                yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    @contextlib.contextmanager
+    def labels(self, **labels):
+        token = labels_in_context.set({**labels_in_context.get(), **labels})
+        try:
+            yield
+        finally:
+            labels_in_context.reset(token)
+
+    def drain(self):
+        """
+        The counters and timers recorded so far, which are reset, for ``merge``
+        into the metrics of another process.
+        """
+        drained = (self.counters, self.timers)
+        self.counters = {}
+        self.timers = {}
+        return drained
+
+    def merge(self, drained):
+        counters, timers = drained
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, (count, seconds) in timers.items():
+            timer = self.timers.setdefault(key, [0, 0.0])
+            timer[0] += count
+            timer[1] += seconds
+
+    def openmetrics(self):
+        lines = []
+        if self.timers:
+            name = f"{PREFIX}_stage_seconds"
+            lines += [f"# TYPE {name} summary", f"# UNIT {name} seconds"]
+            for (stage, labels), (count, seconds) in sorted(self.timers.items()):
+                sample_labels = format_labels((("stage", stage),) + labels)
+                lines.append(f"{name}_count{sample_labels} {count}")
+                lines.append(f"{name}_sum{sample_labels} {seconds:.6f}")
+        for counter in sorted({name for name, _ in self.counters}):
+            name = f"{PREFIX}_{counter}"
+            lines.append(f"# TYPE {name} counter")
+            for (other, labels), value in sorted(self.counters.items()):
+                if other == counter:
+                    lines.append(f"{name}_total{format_labels(labels)} {value}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def write_openmetrics(self, file_path):
+        # Scrapers never see a partial file
+        atomic_file.write_text(file_path, self.openmetrics())
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+# The metrics of this process
+METRICS = Metrics()
+
+configure = METRICS.configure
+observe = METRICS.observe
+count = METRICS.count
+stage = METRICS.stage
+labels = METRICS.labels
+drain = METRICS.drain
+merge = METRICS.merge
+write_openmetrics = METRICS.write_openmetrics
@@ -0,0 +1,210 @@
+import logging
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import sketches
+
+log = logging.getLogger(__name__)
+
+# Per-job values kept in raw mode, and the per-job expression for each of them.
+# The same as the sketches, so that both modes add the same percentile columns.
+RAW_METRICS = dict(sketches.SKETCH_METRICS)
+
+# Megabytes
+DEFAULT_MEMORY_BUDGET = 1024
+
+
+class JobStore:
+    """
+    Job-level metrics held as compact arrays: an int32 code per job for its tool,
+    an int16 code for where it came from and a float32 per metric. When the
+    buffered jobs outgrow the memory budget they are sorted by tool and spilled to
+    disk as a run. Percentiles are computed one block of tools at a time, so only
+    one block is ever in memory.
+    """
+
+    def __init__(self, metrics=RAW_METRICS, memory_budget=DEFAULT_MEMORY_BUDGET, spill_dir=None):
+        self.metrics = list(metrics)
+        self.memory_budget = memory_budget * 1024 * 1024
+        self.spill_dir = spill_dir
+        self.tool_codes = {}
+        self.discarded = set()
+        self.num_sources = 0
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.runs = []
+        self.tmp_dir = None
+        self.num_jobs = 0
+
+    @property
+    def row_bytes(self):
+        return 4 + 2 + 4 * len(self.metrics)
+
+    def new_source(self):
+        """
+        Id to append jobs under, so that they can be discarded again if the query
+        producing them fails half way.
+        """
+        self.num_sources += 1
+        return self.num_sources - 1
+
+    def discard(self, source):
+        self.discarded.add(source)
+
+    def encode(self, tools):
+        local_codes, uniques = pd.factorize(np.asarray(tools, dtype=object))
+        lookup = np.fromiter(
+            (self.tool_codes.setdefault(tool, len(self.tool_codes)) for tool in uniques),
+            dtype=np.int32,
+            count=len(uniques),
+        )
+        return np.where(local_codes >= 0, lookup[local_codes], -1).astype(np.int32)
+
+    def append(self, source, tools, columns):
+        """
+        Add jobs: their tool names and a sequence of values per metric.
+        """
+        codes = self.encode(tools)
+        chunk = {
+            "code": codes,
+            "source": np.full(len(codes), source, dtype=np.int16),
+        }
+        for metric in self.metrics:
+            chunk[metric] = np.asarray(columns[metric], dtype=np.float32)
+        self.buffer.append(chunk)
+        self.buffered_bytes += len(codes) * self.row_bytes
+        self.num_jobs += len(codes)
+        if self.buffered_bytes > self.memory_budget // 2:
+            self.spill()
+
+    def append_rows(self, source, rows):
+        """
+        Add jobs from result rows of (tool, metric...) in ``self.metrics`` order.
+        """
+        if not rows:
+            return
+        tools, *values = zip(*rows)
+        columns = {
+            metric: np.array(column, dtype=np.float32)
+            for metric, column in zip(self.metrics, values)
+        }
+        self.append(source, tools, columns)
+
+    def take_buffer(self):
+        """
+        The buffered jobs as one set of arrays sorted by tool code.
+        """
+        arrays = {
+            column: np.concatenate([chunk[column] for chunk in self.buffer])
+            for column in ["code", "source"] + self.metrics
+        }
+        self.buffer = []
+        self.buffered_bytes = 0
+        order = np.argsort(arrays["code"], kind="stable")
+        return {column: values[order] for column, values in arrays.items()}
+
+    def spill(self):
+        if not self.buffer:
+            return
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.TemporaryDirectory(
+                prefix="tpv-db-optimizer-", dir=self.spill_dir
+            )
+        arrays = self.take_buffer()
+        run = {}
+        for column, values in arrays.items():
+            path = os.path.join(self.tmp_dir.name, f"run{len(self.runs)}-{column}.npy")
+            np.save(path, values)
+            run[column] = path
+        # Jobs per tool code, to find each tool's slice of the run without reading it
+        run["counts"] = np.bincount(arrays["code"][arrays["code"] >= 0])
+        run["offset"] = int(np.count_nonzero(arrays["code"] < 0))
+        self.runs.append(run)
+        log.debug(f"Spilled {len(arrays['code'])} jobs to disk")
+
+    def blocks(self):
+        """
+        Yield arrays of jobs sorted by tool code, each holding every job of a range
+        of tools and fitting in the memory budget.
+        """
+        if not self.runs:
+            if self.buffer:
+                yield self.take_buffer()
+            return
+        self.spill()
+        num_codes = len(self.tool_codes)
+        counts = [np.pad(run["counts"], (0, num_codes - len(run["counts"]))) for run in self.runs]
+        # Start of each tool's jobs in each run
+        starts = [
+            run["offset"] + np.concatenate([[0], np.cumsum(run_counts)])
+            for run, run_counts in zip(self.runs, counts)
+        ]
+        total = np.cumsum(np.sum(counts, axis=0))
+        # Leave room for the sorting done on each block
+        block_rows = max(self.memory_budget // (4 * self.row_bytes), 1)
+        first = 0
+        while first < num_codes:
+            done = total[first - 1] if first else 0
+            last = max(int(np.searchsorted(total, done + block_rows, side="right")), first + 1)
+            last = min(last, num_codes)
+            parts = {column: [] for column in ["code", "source"] + self.metrics}
+            for run, run_starts in zip(self.runs, starts):
+                begin, end = run_starts[first], run_starts[last]
+                for column in parts:
+                    values = np.load(run[column], mmap_mode="r")
+                    parts[column].append(np.array(values[begin:end]))
+            yield {column: np.concatenate(values) for column, values in parts.items()}
+            first = last
+
+    def quantiles(self, percentiles):
+        """
+        Exact percentiles (0-100, linearly interpolated) of every metric per tool,
+        with the same ``<metric>_p<percentile>`` columns as sketches.quantiles.
+        """
+        tools = np.array(list(self.tool_codes), dtype=object)
+        frames = []
+        for block in self.blocks():
+            keep = block["code"] >= 0
+            if self.discarded:
+                keep &= ~np.isin(block["source"], list(self.discarded))
+            frames.append(block_quantiles(block, keep, self.metrics, percentiles))
+        self.close()
+        if not frames:
+            return pd.DataFrame(index=pd.Index([], name="tpv_tool_name"))
+        result = pd.concat(frames)
+        result.index = pd.Index(tools[result.index.to_numpy()], name="tpv_tool_name")
+        return result
+
+    def close(self):
+        if self.tmp_dir is not None:
+            self.tmp_dir.cleanup()
+            self.tmp_dir = None
+            self.runs = []
+
+
+def block_quantiles(block, keep, metrics, percentiles):
+    """
+    Percentiles per tool code of a block of jobs already sorted by tool code.
+    """
+    columns = {}
+    for metric in metrics:
+        values = block[metric]
+        present = keep & ~np.isnan(values)
+        codes = block["code"][present]
+        values = values[present].astype(np.float64)
+        # Sort by value within each tool; codes are already in order
+        order = np.lexsort((values, codes))
+        codes, values = codes[order], values[order]
+        tool_codes, starts, counts = np.unique(codes, return_index=True, return_counts=True)
+        for percentile in percentiles:
+            rank = percentile / 100.0 * (counts - 1)
+            lower = np.floor(rank).astype(np.int64)
+            upper = np.minimum(lower + 1, counts - 1)
+            low, high = values[starts + lower], values[starts + upper]
+            columns[f"{metric}_p{percentile:g}"] = pd.Series(
+                low + (rank - lower) * (high - low), index=tool_codes
+            )
+    return pd.DataFrame(columns)
@@ -0,0 +1,252 @@
+import argparse
+import asyncio
+import logging
+import sys
+
+import numpy as np
+import pandas as pd
+
+import aggregation
+import db
+import local_backend
+import tool_matching
+import yaml_io
+from registry import load_registry, redact, registry_from_uris
+
+# Configure logging to print to stdout
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# Create a stream handler to print to stdout
+handler = logging.StreamHandler(sys.stdout)
+handler.setLevel(logging.DEBUG)
+
+# Create a formatter and set it for the handler
+formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
+handler.setFormatter(formatter)
+
+# Add the handler to the logger
+log.addHandler(handler)
+
+# Replays the job history of the usage tables against the mem and cores of a
+# candidate tools.yml: a job is predicted to fail when it used more memory than
+# its tool would now get, and to be CPU-starved when it kept more cores busy on
+# average than its tool would now get.
+
+SQL_JOB_QUERY_TEMPLATE = """
+SELECT tpv_tool_name, tpv_mem_gb, tpv_cores, job_max_mem_gb, runtime_seconds, actual_cpu_seconds
+FROM {relation} WHERE
+  updated >= CURRENT_DATE - {window};
+"""
+
+JOB_RELATIONS = {
+    "table": "{region}_job_resource_usage",
+    "view": "{region}_job_resource_usage_view",
+}
+
+JOB_COLUMNS = [
+    "tpv_mem_gb",
+    "tpv_cores",
+    "job_max_mem_gb",
+    "runtime_seconds",
+    "actual_cpu_seconds",
+]
+
+DEFAULT_WINDOW_DAYS = aggregation.DEFAULT_WINDOW_DAYS
+
+
+async def fetch_jobs(databases, source="table", window=DEFAULT_WINDOW_DAYS):
+    async def fetch(engine, database, region, relations):
+        query = SQL_JOB_QUERY_TEMPLATE.format(
+            relation=relations.get(source, JOB_RELATIONS[source].format(region=region)),
+            window=int(window),
+        )
+        chunks = db.stream_data(engine, query)
+        builder = db.ColumnarBuilder(await anext(chunks))
+        async for rows in chunks:
+            builder.append(rows)
+        log.debug(
+            f"Fetched {builder.num_rows} jobs for {region} on {redact(database['uri'])}"
+        )
+        return builder.to_frame()
+
+    engines = [db.create_engine(database) for database in databases]
+    try:
+        frames = await asyncio.gather(
+            *(
+                fetch(engine, database, region, relations)
+                for database, engine in zip(databases, engines)
+                for region, relations in database["regions"].items()
+            )
+        )
+    finally:
+        for engine in engines:
+            await engine.dispose()
+    return pd.concat(frames, ignore_index=True)
+
+
+def load_jobs(dump_dir, window=DEFAULT_WINDOW_DAYS):
+    frames = []
+    for region in local_backend.dump_regions(dump_dir):
+        usage = local_backend.in_window(
+            local_backend.load_usage(dump_dir, region), window
+        )
+        frames.append(usage[["tpv_tool_name"] + JOB_COLUMNS])
+        log.debug(f"Loaded {len(usage)} jobs for {region} from {dump_dir}")
+    return pd.concat(frames, ignore_index=True)
+
+
+def resolve_allocations(tools, shared_db):
+    """
+    The tools.yml key, mem and cores each tool resolves to, matched the way
+    update-shared-db.py matches them. mem and cores are NaN when not set.
+    """
+    tool_entries = shared_db.get("tools") or {}
+    matcher = tool_matching.ToolMatcher(tool_entries)
+    keys = []
+    mem = np.full(len(tools), np.nan)
+    cores = np.full(len(tools), np.nan)
+    for index, tool in enumerate(tools):
+        match = matcher.match(tool)
+        keys.append(match.key if match else None)
+        entry = (tool_entries.get(match.key) if match else None) or {}
+        mem[index] = aggregation.to_float(entry.get("mem"))
+        cores[index] = aggregation.to_float(entry.get("cores"))
+    return keys, mem, cores
+
+
+def replay(jobs, shared_db):
+    """
+    Per-tool and fleet-wide predictions for ``jobs`` under ``shared_db``. Tools
+    without mem or cores in ``shared_db`` keep the allocations they had.
+    """
+    codes, tools = pd.factorize(jobs["tpv_tool_name"])
+    jobs = jobs[codes >= 0]
+    codes = codes[codes >= 0]
+    keys, tool_mem, tool_cores = resolve_allocations(list(tools), shared_db)
+
+    column = {name: jobs[name].to_numpy(np.float64) for name in JOB_COLUMNS}
+    mem = tool_mem[codes]
+    mem = np.where(np.isnan(mem), column["tpv_mem_gb"], mem)
+    cores = tool_cores[codes]
+    cores = np.where(np.isnan(cores), column["tpv_cores"], cores)
+    hours = column["runtime_seconds"] / 3600
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        busy_cores = column["actual_cpu_seconds"] / column["runtime_seconds"]
+    # Comparisons with NaN are False, so jobs lacking data never count as failing
+    failed = column["job_max_mem_gb"] > mem
+    starved = busy_cores > cores
+    reclaimed_gb_hours = np.nan_to_num((column["tpv_mem_gb"] - mem) * hours)
+    reclaimed_core_hours = np.nan_to_num((column["tpv_cores"] - cores) * hours)
+
+    def per_tool(weights=None):
+        return np.bincount(codes, weights=weights, minlength=len(tools))
+
+    report = pd.DataFrame(
+        {
+            "tpv_tool_name": tools,
+            "tools_yml_key": keys,
+            "mem": tool_mem,
+            "cores": tool_cores,
+            "num_jobs": per_tool(),
+            "predicted_failures": per_tool(failed).astype(np.int64),
+            "cpu_starved": per_tool(starved).astype(np.int64),
+            "reclaimed_gb_hours": per_tool(reclaimed_gb_hours),
+            "reclaimed_core_hours": per_tool(reclaimed_core_hours),
+        }
+    )
+    report["failure_rate"] = report["predicted_failures"] / report["num_jobs"]
+    report["cpu_starved_rate"] = report["cpu_starved"] / report["num_jobs"]
+    fleet = {
+        "num_jobs": len(codes),
+        "predicted_failures": int(failed.sum()),
+        "failure_rate": float(failed.mean()) if len(codes) else 0.0,
+        "cpu_starved": int(starved.sum()),
+        "cpu_starved_rate": float(starved.mean()) if len(codes) else 0.0,
+        "reclaimed_gb_hours": float(reclaimed_gb_hours.sum()),
+        "reclaimed_core_hours": float(reclaimed_core_hours.sum()),
+    }
+    return report.sort_values("predicted_failures", ascending=False), fleet
+
+
+def main(tools_path, jobs, report_path=None, max_failure_rate=None):
+    shared_db = yaml_io.load(tools_path)
+    report, fleet = replay(jobs, shared_db)
+    for name, value in fleet.items():
+        log.info(f"{name}: {value}")
+    if report_path:
+        report.to_csv(report_path, index=False)
+        log.debug(f"Per-tool predictions written to {report_path}")
+    if max_failure_rate is not None and fleet["failure_rate"] > max_failure_rate:
+        log.error(
+            f"Predicted failure rate {fleet['failure_rate']:.4%} is over {max_failure_rate:.4%}"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Predict failures and reclaimed resources of a tools.yml by replaying historical jobs."
+    )
+    parser.add_argument(
+        "tools_path", type=str, help="Path to the candidate TPV shared database YAML file"
+    )
+    parser.add_argument(
+        "database_uris",
+        metavar="N",
+        type=str,
+        nargs="*",
+        help="Database URIs to read job history from, every region is read from each of them",
+    )
+    parser.add_argument(
+        "--config",
+        help="Registry file listing each database URI and the regions it holds",
+    )
+    parser.add_argument(
+        "--statement-timeout",
+        type=float,
+        help="Seconds after which the database cancels a query, unless the registry entry sets "
+        "its own statement_timeout. No timeout by default",
+    )
+    parser.add_argument(
+        "--dump-dir",
+        help="Read job history from exported <region>_job and <region>_job_metric_numeric tables instead",
+    )
+    parser.add_argument(
+        "--source",
+        choices=list(JOB_RELATIONS),
+        default="table",
+        help="Read job history from the incrementally refreshed tables or the materialized views",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=DEFAULT_WINDOW_DAYS,
+        help="Number of days of job history to replay",
+    )
+    parser.add_argument(
+        "--report",
+        help="CSV file to write per-tool predictions to",
+    )
+    parser.add_argument(
+        "--max-failure-rate",
+        type=float,
+        help="Exit with status 1 when the fraction of jobs predicted to fail is over this, "
+        "e.g. 0.001, to gate automated updates",
+    )
+    args = parser.parse_intermixed_args()
+
+    if args.dump_dir:
+        jobs = load_jobs(args.dump_dir, args.window)
+    else:
+        if args.config:
+            databases = load_registry(args.config, args.statement_timeout)
+        elif args.database_uris:
+            databases = registry_from_uris(args.database_uris, args.statement_timeout)
+        else:
+            parser.error("Pass database URIs, --config or --dump-dir")
+        jobs = asyncio.run(fetch_jobs(databases, args.source, args.window))
+    log.debug(f"Replaying {len(jobs)} jobs against {args.tools_path}")
+    sys.exit(main(args.tools_path, jobs, args.report, args.max_failure_rate))
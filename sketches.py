@@ -0,0 +1,87 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+# Fixed logarithmic buckets: a value v > 0 falls in bucket ceil(log_gamma(v)), and
+# every value in a bucket is within RELATIVE_ACCURACY of the bucket's representative
+# value. Histograms with the same gamma are merged by adding counts per bucket, so
+# per-region, per-day sketches can be combined in any order.
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LN_GAMMA = math.log(GAMMA)
+
+# Zero and negative values are all counted in a single bucket below any real one
+ZERO_BUCKET = -(2**31)
+
+# Distributions kept per tool, and the per-job expression for each of them
+SKETCH_METRICS = {
+    "job_max_mem_gb": "job_max_mem_gb",
+    "cpu_fraction": "actual_cpu_seconds / NULLIF(allocated_cpu_seconds, 0)",
+    "runtime_seconds": "runtime_seconds",
+}
+
+SKETCH_KEYS = ["tpv_tool_name", "metric"]
+
+
+def bucket_sql(value):
+    """
+    SQL expression mapping ``value`` to its bucket, or NULL when ``value`` is NULL.
+    """
+    return (
+        f"CASE WHEN {value} > 0 THEN CEIL(LN({value}) / {LN_GAMMA!r})::integer "
+        f"WHEN {value} IS NOT NULL THEN {ZERO_BUCKET} END"
+    )
+
+
+def to_buckets(values):
+    values = np.asarray(values, dtype=np.float64)
+    buckets = np.full(values.shape, ZERO_BUCKET, dtype=np.int64)
+    positive = values > 0
+    buckets[positive] = np.ceil(np.log(values[positive]) / LN_GAMMA)
+    return buckets
+
+
+def bucket_values(buckets):
+    """
+    Representative value of each bucket, i.e. the point with equal relative
+    distance to both bucket boundaries.
+    """
+    buckets = np.asarray(buckets, dtype=np.int64)
+    values = 2 * np.power(GAMMA, buckets.astype(np.float64)) / (GAMMA + 1)
+    values[buckets == ZERO_BUCKET] = 0.0
+    return values
+
+
+def merge(sketch_df):
+    """
+    Merge sketch rows (tpv_tool_name, metric, bucket, count) from any number of
+    regions or days into one histogram per tool and metric, sorted by bucket.
+    """
+    merged = sketch_df.groupby(SKETCH_KEYS + ["bucket"], as_index=False, sort=True)[
+        "count"
+    ].sum()
+    merged["bucket"] = merged["bucket"].astype(np.int64)
+    merged["count"] = merged["count"].astype(np.int64)
+    return merged
+
+
+def quantiles(merged_df, percentiles):
+    """
+    Compute the given percentiles (0-100) of every merged histogram. Returns one
+    row per tool with a ``<metric>_p<percentile>`` column per metric and percentile.
+    """
+    if merged_df.empty:
+        return pd.DataFrame(index=pd.Index([], name="tpv_tool_name"))
+    cumulative = merged_df.groupby(SKETCH_KEYS, sort=False)["count"].cumsum()
+    total = merged_df.groupby(SKETCH_KEYS, sort=False)["count"].transform("sum")
+    columns = {}
+    for percentile in percentiles:
+        rank = percentile / 100.0 * (total - 1)
+        # First bucket in each histogram whose cumulative count passes the rank
+        hits = merged_df[cumulative > rank]
+        first = hits.groupby(SKETCH_KEYS, sort=False)["bucket"].first()
+        values = pd.Series(bucket_values(first.to_numpy()), index=first.index)
+        for metric, series in values.groupby(level="metric"):
+            columns[f"{metric}_p{percentile:g}"] = series.droplevel("metric")
+    return pd.DataFrame(columns).rename_axis("tpv_tool_name")
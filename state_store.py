@@ -0,0 +1,88 @@
+import datetime
+import json
+import os
+
+import pandas as pd
+
+import atomic_file
+import interchange
+
+DEFAULT_STATE_DIR = os.path.join(
+    os.environ.get("XDG_STATE_HOME", os.path.expanduser("~/.local/state")),
+    "tpv-db-optimizer",
+)
+
+STATE_FILE = "state.json"
+RECOMMENDATIONS_FILE = "recommendations.arrow"
+
+
+class StateStore:
+    """
+    What the daemon mode of mem-optimize.py keeps between cycles: per region of
+    each database, the query results of every tool (one Parquet file per kind of
+    result) and the date its window started on at the last cycle, and the
+    recommendations last produced for every tool. Databases are told apart by
+    their registry.database_label.
+    """
+
+    def __init__(self, state_dir=DEFAULT_STATE_DIR):
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def load_state(self):
+        try:
+            with open(self.path(STATE_FILE)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+
+    def save_state(self, state):
+        def write(path):
+            with open(path, "w") as file:
+                json.dump(state, file, indent=2, default=str)
+
+        atomic_file.replace_file(self.path(STATE_FILE), write)
+
+    def region_path(self, database, region, kind):
+        return self.path(f"{database}-{region}-{kind}.parquet")
+
+    def load_region(self, database, region, kind):
+        try:
+            return pd.read_parquet(self.region_path(database, region, kind))
+        except FileNotFoundError:
+            return None
+
+    def update_region(self, database, region, kind, df, tools=None):
+        """
+        Replace the rows of ``tools`` (every tool when None) in a region's results
+        with those in ``df``. Tools missing from ``df`` no longer have any jobs in
+        the window and are dropped.
+        """
+        df = df.astype({"tpv_tool_name": object})
+        stored = None if tools is None else self.load_region(database, region, kind)
+        if stored is not None:
+            kept = stored[~stored["tpv_tool_name"].isin(tools)]
+            df = pd.concat([kept, df], ignore_index=True) if len(df) else kept
+        atomic_file.replace_file(
+            self.region_path(database, region, kind),
+            lambda path: df.to_parquet(path, index=False),
+        )
+
+    def load_recommendations(self):
+        try:
+            table, _ = interchange.read(self.path(RECOMMENDATIONS_FILE))
+        except FileNotFoundError:
+            return None
+        return table.to_pandas()
+
+    def save_recommendations(self, df, metadata):
+        interchange.write(self.path(RECOMMENDATIONS_FILE), df, metadata)
+
+    def delta_path(self, delta_dir=None):
+        delta_dir = delta_dir or self.path("deltas")
+        os.makedirs(delta_dir, exist_ok=True)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return os.path.join(delta_dir, f"delta-{now:%Y%m%dT%H%M%S}.arrow")
@@ -0,0 +1,154 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import local_backend
+
+# Synthetic stand-ins for a federation of Galaxy servers, for benchmark.py: tool
+# ids with several versions each, job-level usage per region with the columns of
+# local_backend.job_usage, and a tools.yml to match them against. Job counts per
+# tool follow a Zipf law and usage is log-normal, like real job histories where a
+# few tools run most of the jobs.
+
+TOOLSHED = "toolshed.g2.bx.psu.edu/repos"
+BUILTIN_TOOLS = ["upload1", "__SET_METADATA__", "cat1", "__DATA_FETCH__", "sort1"]
+MEM_SIZES_GB = np.array([1.0, 2.0, 3.8, 7.6, 15.2, 30.4, 61.4, 122.8])
+CORE_COUNTS = np.array([1, 2, 4, 8, 16, 32])
+
+
+def tool_ids(num_tools, versions=3, rng=None):
+    """
+    ``num_tools`` tools from a few hundred owners, with up to ``versions``
+    versions each. Returns the tool ids and the versionless tpv tool name of each.
+    """
+    rng = rng or np.random.default_rng(0)
+    ids = []
+    names = []
+    for index in range(num_tools):
+        if index < len(BUILTIN_TOOLS):
+            ids.append(BUILTIN_TOOLS[index])
+            names.append(BUILTIN_TOOLS[index])
+            continue
+        name = f"{TOOLSHED}/owner{index % 331}/repo{index}/tool{index}"
+        for version in range(int(rng.integers(1, versions + 1))):
+            ids.append(f"{name}/{version}.{int(rng.integers(0, 10))}.0")
+            names.append(name)
+    return ids, names
+
+
+def zipf_weights(count, exponent=1.1, rng=None):
+    rng = rng or np.random.default_rng(0)
+    weights = 1.0 / np.arange(1, count + 1) ** exponent
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+def job_usage(num_jobs, tools, rng=None, window=365):
+    """
+    Job-level usage rows over the last ``window`` days, as local_backend.job_usage
+    returns them. ``tools`` is the (tool ids, tpv tool names) pair of tool_ids.
+    """
+    rng = rng or np.random.default_rng(0)
+    ids, names = np.asarray(tools[0], dtype=object), np.asarray(tools[1], dtype=object)
+    codes = rng.choice(len(ids), size=num_jobs, p=zipf_weights(len(ids), rng=rng))
+
+    # Every tool has a typical allocation and uses a typical fraction of it
+    tool_mem = rng.choice(MEM_SIZES_GB, size=len(ids), p=[0.1, 0.15, 0.3, 0.2, 0.12, 0.08, 0.04, 0.01])
+    tool_cores = rng.choice(CORE_COUNTS, size=len(ids), p=[0.35, 0.2, 0.2, 0.15, 0.07, 0.03])
+    tool_mem_used = rng.beta(2, 5, size=len(ids))
+    tool_cpu_used = rng.beta(2, 3, size=len(ids))
+    tool_runtime = rng.lognormal(6, 1.5, size=len(ids))
+
+    tpv_mem_gb = tool_mem[codes]
+    tpv_cores = tool_cores[codes].astype(np.float64)
+    job_max_mem_gb = np.minimum(
+        tpv_mem_gb * tool_mem_used[codes] * rng.lognormal(0, 0.5, size=num_jobs),
+        tpv_mem_gb * 1.2,
+    )
+    runtime_seconds = np.ceil(tool_runtime[codes] * rng.lognormal(0, 1, size=num_jobs))
+    allocated_cpu_seconds = tpv_cores * runtime_seconds
+    actual_cpu_seconds = allocated_cpu_seconds * np.clip(
+        tool_cpu_used[codes] * rng.lognormal(0, 0.3, size=num_jobs), 0, 1
+    )
+    # Some jobs don't report every metric
+    actual_cpu_seconds[rng.random(num_jobs) < 0.02] = np.nan
+
+    now = np.datetime64(datetime.datetime.now(), "s")
+    age = rng.integers(0, window * 24 * 3600, size=num_jobs).astype("timedelta64[s]")
+    short_names = np.array([name.rsplit("/", 1)[-1] for name in names], dtype=object)
+    return pd.DataFrame(
+        {
+            "job_id": np.arange(1, num_jobs + 1),
+            "updated": now - age,
+            "tool_id": ids[codes],
+            "tool_name": short_names[codes],
+            "tpv_tool_name": names[codes],
+            "tpv_cores": tpv_cores,
+            "tpv_mem_gb": tpv_mem_gb,
+            "job_max_mem_gb": job_max_mem_gb,
+            "runtime_seconds": runtime_seconds,
+            "actual_cpu_seconds": actual_cpu_seconds,
+            "allocated_cpu_seconds": allocated_cpu_seconds,
+            "destination": rng.choice(["slurm", "pulsar", "k8s"], size=num_jobs),
+        }
+    )
+
+
+def federation(num_tools, num_jobs, regions=("au", "eu", "us"), seed=0):
+    """
+    Job-level usage of each region. Regions share the tool catalogue but run
+    different mixes of it.
+    """
+    rng = np.random.default_rng(seed)
+    tools = tool_ids(num_tools, rng=rng)
+    return {
+        region: job_usage(num_jobs // len(regions), tools, rng)
+        for region in regions
+    }
+
+
+def resource_frames(usage_by_region):
+    """
+    Per-region aggregates, as returned by the resource queries.
+    """
+    return [local_backend.resource_aggregates(usage) for usage in usage_by_region.values()]
+
+
+def shared_db(tool_names, extra_tools=0, rng=None):
+    """
+    A tools.yml like the TPV shared database for ``tool_names``: most tools have a
+    ``/.*`` entry, some only version specific entries, some a regex entry and some
+    none at all, plus ``extra_tools`` entries for tools that never ran.
+    """
+    rng = rng or np.random.default_rng(0)
+    tools = {}
+    names = list(dict.fromkeys(tool_names)) + [
+        f"{TOOLSHED}/unused{index % 97}/repo{index}/unused{index}"
+        for index in range(extra_tools)
+    ]
+    for name in names:
+        kind = rng.random()
+        entry = {
+            "mem": float(rng.choice(MEM_SIZES_GB)),
+            "cores": int(rng.choice(CORE_COUNTS)),
+        }
+        if rng.random() < 0.1:
+            entry["env"] = {"_JAVA_OPTIONS": "-Xmx{int(mem)}G"}
+        if rng.random() < 0.05:
+            entry["rules"] = [
+                {"if": "input_size >= 10", "mem": entry["mem"] * 2},
+            ]
+        if name in BUILTIN_TOOLS or kind < 0.75:
+            tools[f"{name}/.*" if "/" in name else name] = entry
+        elif kind < 0.85:
+            tools[f"{name}/1.0.0"] = entry
+            tools[f"{name}/2.0.0"] = dict(entry, mem=entry["mem"] * 2)
+        elif kind < 0.9:
+            owner, repo, tool = name.rsplit("/", 3)[1:]
+            tools[f"{TOOLSHED}/{owner}/{repo}/{tool}[^/]*/.*"] = entry
+        # The rest has no entry, and gets one added
+    return {
+        "global": {"default_inherits": "default"},
+        "tools": {"default": {"cores": 1, "mem": 3.8}, **tools},
+    }
@@ -0,0 +1,28 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+def load_script(name, file_name):
+    # The scripts have dashes in their names, so they can't be imported
+    spec = importlib.util.spec_from_file_location(name, os.path.join(REPO_DIR, file_name))
+    module = importlib.util.module_from_spec(spec)
+    # Registered so that worker processes can find its functions
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def update_shared_db():
+    return load_script("update_shared_db", "update-shared-db.py")
+
+
+@pytest.fixture(scope="session")
+def mem_optimize():
+    return load_script("mem_optimize", "mem-optimize.py")
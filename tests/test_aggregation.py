@@ -0,0 +1,90 @@
+import math
+
+import pandas as pd
+import pytest
+
+import aggregation
+
+
+def row(tool, num_jobs=10, **values):
+    # Per-region summary of a tool, well over both thresholds unless overridden
+    defaults = {
+        "mem_wastage_min_gb": 4.0,
+        "avg_tpv_mem_gb": 16.0,
+        "max_tpv_mem_gb": 16.0,
+        "max_job_max_mem_gb": 12.0,
+        "cpu_wastage_min_seconds": 1000.0,
+        "avg_tpv_cores": 4.0,
+        "max_tpv_cores": 4.0,
+        "avg_allocated_cpu_seconds": 4000.0,
+        "max_allocated_cpu_seconds": 8000.0,
+        "avg_actual_cpu_seconds": 2000.0,
+        "max_actual_cpu_seconds": 6000.0,
+    }
+    return {"tpv_tool_name": tool, "num_jobs": float(num_jobs), **defaults, **values}
+
+
+def wastage(*rows):
+    return aggregation.find_wastage(pd.DataFrame(rows)).set_index("tpv_tool_name")
+
+
+def test_means_are_weighted_by_jobs():
+    result = wastage(
+        row("bwa", num_jobs=10, avg_tpv_mem_gb=8.0, avg_actual_cpu_seconds=1000.0),
+        row("bwa", num_jobs=30, avg_tpv_mem_gb=16.0, avg_actual_cpu_seconds=3000.0),
+    ).loc["bwa"]
+    assert result["num_jobs"] == 40
+    assert result["avg_tpv_mem_gb"] == pytest.approx((10 * 8 + 30 * 16) / 40)
+    assert result["avg_actual_cpu_seconds"] == pytest.approx((10 * 1000 + 30 * 3000) / 40)
+
+
+def test_missing_values_carry_no_weight():
+    result = wastage(
+        row("bwa", num_jobs=10, avg_tpv_cores=math.nan),
+        row("bwa", num_jobs=30, avg_tpv_cores=2.0),
+    ).loc["bwa"]
+    assert result["avg_tpv_cores"] == pytest.approx(2.0)
+
+
+def test_min_and_max_across_regions():
+    result = wastage(
+        row("bwa", mem_wastage_min_gb=6.0, max_tpv_mem_gb=16.0, max_tpv_cores=math.nan),
+        row("bwa", mem_wastage_min_gb=3.0, max_tpv_mem_gb=32.0, max_tpv_cores=8.0),
+    ).loc["bwa"]
+    assert result["mem_wastage_min_gb"] == pytest.approx(3.0 * aggregation.WASTAGE_LEEWAY)
+    assert result["max_tpv_mem_gb"] == 32.0
+    assert result["max_tpv_cores"] == 8.0
+
+
+def test_leeway_is_taken_off_the_minimum_wastage():
+    result = wastage(row("bwa", mem_wastage_min_gb=2.0, cpu_wastage_min_seconds=400.0)).loc["bwa"]
+    assert result["mem_wastage_min_gb"] == pytest.approx(2.0 * aggregation.WASTAGE_LEEWAY)
+    assert result["cpu_wastage_min_seconds"] == pytest.approx(400.0 * aggregation.WASTAGE_LEEWAY)
+
+
+def test_thresholds_mask_columns_and_drop_tools():
+    mem_threshold = aggregation.MEM_WASTAGE_THRESHOLD_GB
+    cpu_threshold = aggregation.CPU_WASTAGE_THRESHOLD_SECONDS
+    result = wastage(
+        row("mem_only", cpu_wastage_min_seconds=cpu_threshold / 2),
+        row("cpu_only", mem_wastage_min_gb=mem_threshold / 2),
+        row("neither", mem_wastage_min_gb=0.0, cpu_wastage_min_seconds=0.0),
+        # Over the thresholds only until the leeway is taken off
+        row(
+            "within_leeway",
+            mem_wastage_min_gb=mem_threshold * 1.02,
+            cpu_wastage_min_seconds=cpu_threshold * 1.02,
+        ),
+    )
+    assert sorted(result.index) == ["cpu_only", "mem_only"]
+    assert result.loc["mem_only", list(aggregation.MEM_STATS)].notna().all()
+    assert result.loc["mem_only", list(aggregation.CPU_STATS)].isna().all()
+    assert result.loc["cpu_only", list(aggregation.CPU_STATS)].notna().all()
+    assert result.loc["cpu_only", list(aggregation.MEM_STATS)].isna().all()
+    # num_jobs is kept either way
+    assert result["num_jobs"].notna().all()
+
+
+def test_weighted_mean():
+    df = pd.DataFrame({"value": [1.0, 2.0, 4.0], "num_jobs": [1.0, 2.0, 3.0]})
+    assert aggregation.weighted_mean(df, "value") == pytest.approx((1 + 4 + 12) / 6)
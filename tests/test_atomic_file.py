@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+import atomic_file
+
+
+def test_replaces_the_file_keeping_its_mode(tmp_path):
+    path = tmp_path / "tools.yml"
+    path.write_text("old\n")
+    path.chmod(0o640)
+    atomic_file.write_text(str(path), "new\n")
+    assert path.read_text() == "new\n"
+    assert path.stat().st_mode & 0o777 == 0o640
+    assert os.listdir(tmp_path) == ["tools.yml"]
+
+
+def test_leaves_the_file_alone_when_writing_fails(tmp_path):
+    path = tmp_path / "output.arrow"
+    path.write_text("old\n")
+
+    def write(tmp_path):
+        with open(tmp_path, "w") as file:
+            file.write("partial")
+        raise OSError("disk full")
+
+    with pytest.raises(OSError):
+        atomic_file.replace_file(str(path), write)
+    assert path.read_text() == "old\n"
+    assert os.listdir(tmp_path) == ["output.arrow"]
@@ -0,0 +1,198 @@
+import asyncio
+import datetime
+import json
+import os
+import random
+
+import pandas as pd
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import db
+import local_backend
+import views
+from registry import normalize_database, redact
+
+# A scratch Postgres database to compare local_backend against, e.g.
+# postgresql+asyncpg://postgres@localhost/tpv_test. Its <region>_job and usage
+# tables are dropped and recreated.
+DATABASE_URI = os.environ.get("TPV_TEST_DATABASE_URI")
+
+WINDOW = 365
+TOOLS = [
+    f"toolshed.g2.bx.psu.edu/repos/iuc/repo{i}/tool{i}/1.{version}"
+    for i in range(6)
+    for version in range(2)
+] + ["upload1"]
+
+
+def region_tables(region, num_jobs=300, seed=0):
+    """
+    Rows of a region's job and job_metric_numeric tables, with the region's
+    metric names and destination params.
+    """
+    config = views.REGIONS[region]
+    rng = random.Random(seed)
+    now = datetime.datetime.now().replace(microsecond=0)
+    divisor = float(config["cpu_metric_divisor"])
+    jobs, metrics = [], []
+    for job_id in range(1, num_jobs + 1):
+        cores = rng.choice([1, 2, 4, 8])
+        mem_gb = cores * 3.8
+        destination = "slurm"
+        if config["params_format"] == "json":
+            params = json.dumps({"tpv_cores": cores, "tpv_mem": mem_gb})
+        else:
+            params = f"--ntasks={cores} --mem={int(mem_gb * 1024)}"
+            destination = rng.choice(["jetstream2", "stampede2"])
+            if rng.random() < 0.05:
+                params = f"--mem={int(mem_gb * 1024)}"
+        jobs.append(
+            {
+                "id": job_id,
+                "update_time": now - datetime.timedelta(days=rng.uniform(0, WINDOW + 100)),
+                "tool_id": rng.choice(TOOLS),
+                "state": rng.choice(["ok"] * 9 + ["error"]),
+                "destination_id": destination,
+                "destination_params": params.encode(),
+            }
+        )
+        if rng.random() < 0.03:
+            # Jobs without a memory metric are left out
+            continue
+        runtime = rng.randint(10, 10000)
+        metrics += [
+            (job_id, config["mem_metric"], round(mem_gb * rng.random() * 1024**3)),
+            (job_id, config["runtime_metric"], runtime),
+            (job_id, config["cpu_metric"], round(runtime * cores * rng.random() * divisor)),
+        ]
+    # Keep clear of the window's edge, where the local and database clocks may differ
+    jobs = [job for job in jobs if abs((now - job["update_time"]).days - WINDOW) > 2]
+    metrics = pd.DataFrame(metrics, columns=["job_id", "metric_name", "metric_value"])
+    return pd.DataFrame(jobs), metrics
+
+
+def write_dump(dump_dir, region, jobs, metrics):
+    # As exported with \copy ... CSV HEADER, with bytea in Postgres' hex format
+    jobs = jobs.assign(
+        destination_params=["\\x" + params.hex() for params in jobs["destination_params"]]
+    )
+    jobs.to_csv(os.path.join(dump_dir, f"{region}_job.csv"), index=False)
+    metrics.to_csv(os.path.join(dump_dir, f"{region}_job_metric_numeric.csv"), index=False)
+
+
+async def load_database(uri, tables):
+    engine = create_async_engine(uri)
+    try:
+        async with engine.begin() as connection:
+            await connection.execute(
+                text(
+                    "DROP TABLE IF EXISTS job_resource_usage_watermark, "
+                    "job_resource_usage_dirty_day, job_resource_usage_dirty_tool CASCADE"
+                )
+            )
+            for region, (jobs, metrics) in tables.items():
+                await connection.execute(
+                    text(
+                        f"DROP TABLE IF EXISTS {region}_job, {region}_job_metric_numeric, "
+                        f"{region}_job_resource_usage, {region}_job_resource_usage_daily, "
+                        f"{region}_job_resource_usage_sketch CASCADE"
+                    )
+                )
+                await connection.execute(
+                    text(
+                        f"CREATE TABLE {region}_job (id integer PRIMARY KEY, "
+                        "update_time timestamp, tool_id varchar(255), state varchar(64), "
+                        "destination_id varchar(255), destination_params bytea)"
+                    )
+                )
+                await connection.execute(
+                    text(
+                        f"CREATE TABLE {region}_job_metric_numeric (id serial PRIMARY KEY, "
+                        "job_id integer, metric_name varchar(255), metric_value numeric(26,7))"
+                    )
+                )
+                await connection.execute(
+                    text(
+                        f"INSERT INTO {region}_job VALUES (:id, :update_time, :tool_id, "
+                        ":state, :destination_id, :destination_params)"
+                    ),
+                    jobs.to_dict("records"),
+                )
+                await connection.execute(
+                    text(
+                        f"INSERT INTO {region}_job_metric_numeric (job_id, metric_name, "
+                        "metric_value) VALUES (:job_id, :metric_name, :metric_value)"
+                    ),
+                    [
+                        dict(row, job_id=int(row["job_id"]), metric_value=float(row["metric_value"]))
+                        for row in metrics.to_dict("records")
+                    ],
+                )
+        await views.deploy(engine, list(tables), views=False)
+        for region in tables:
+            await views.refresh_incremental(engine, region)
+    finally:
+        await engine.dispose()
+
+
+async def fetch_resources(mem_optimize, uri, regions, source):
+    engine = db.create_engine(normalize_database({"uri": uri}))
+    try:
+        return {
+            region: await mem_optimize.fetch_data(
+                engine, mem_optimize.get_region_queries(region, source, WINDOW)["resource"]
+            )
+            for region in regions
+        }
+    finally:
+        await engine.dispose()
+
+
+async def can_connect(uri):
+    engine = create_async_engine(uri)
+    try:
+        async with engine.connect():
+            return True
+    except Exception:
+        return False
+    finally:
+        await engine.dispose()
+
+
+@pytest.fixture(scope="module")
+def database_dump(tmp_path_factory):
+    if not DATABASE_URI:
+        pytest.skip("Set TPV_TEST_DATABASE_URI to compare against Postgres")
+    if not asyncio.run(can_connect(DATABASE_URI)):
+        pytest.skip(f"Can't connect to {redact(DATABASE_URI)}")
+    dump_dir = str(tmp_path_factory.mktemp("dump"))
+    tables = {
+        region: region_tables(region, seed=seed) for seed, region in enumerate(views.REGIONS)
+    }
+    for region, (jobs, metrics) in tables.items():
+        write_dump(dump_dir, region, jobs, metrics)
+    asyncio.run(load_database(DATABASE_URI, tables))
+    return dump_dir
+
+
+def by_tool(df):
+    df = df.reindex(columns=local_backend.RESOURCE_COLUMNS)
+    # Tool names come back from the database as categoricals
+    df["tpv_tool_name"] = df["tpv_tool_name"].astype(str)
+    return df.set_index("tpv_tool_name").astype(float).sort_index()
+
+
+@pytest.mark.parametrize("source", ["table", "rollup"])
+def test_dump_matches_sql_aggregates(mem_optimize, database_dump, source):
+    expected = asyncio.run(
+        fetch_resources(mem_optimize, DATABASE_URI, list(views.REGIONS), source)
+    )
+    for region in views.REGIONS:
+        usage = local_backend.load_usage(database_dump, region)
+        actual = local_backend.resource_aggregates(local_backend.in_window(usage, WINDOW))
+        assert len(actual) > 1
+        pd.testing.assert_frame_equal(
+            by_tool(actual), by_tool(expected[region]), check_exact=False, rtol=1e-6
+        )
@@ -0,0 +1,47 @@
+import pandas as pd
+
+import local_backend
+import raw_usage
+import sketches
+import synthetic
+
+PERCENTILES = [50, 95]
+
+
+def test_raw_and_sketch_percentiles_have_the_same_columns():
+    usage = synthetic.federation(20, 3000)["au"]
+    merged = sketches.merge(local_backend.sketch_counts(usage))
+    sketch_df = sketches.quantiles(merged, PERCENTILES)
+
+    store = raw_usage.JobStore()
+    store.append(store.new_source(), usage["tpv_tool_name"], local_backend.metric_values(usage))
+    raw_df = store.quantiles(PERCENTILES)
+
+    assert sorted(raw_df.columns) == sorted(sketch_df.columns)
+    assert sorted(raw_df.index) == sorted(sketch_df.index)
+
+
+def fill(store, usage, chunk_size=10000):
+    values = local_backend.metric_values(usage)
+    for start in range(0, len(usage), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        store.append(
+            store.new_source(),
+            usage["tpv_tool_name"][chunk],
+            {metric: column[chunk] for metric, column in values.items()},
+        )
+
+
+def test_spilled_percentiles_match_in_memory(tmp_path):
+    usage = synthetic.federation(200, 120000, regions=["au"])["au"]
+    in_memory = raw_usage.JobStore()
+    fill(in_memory, usage)
+    spilled = raw_usage.JobStore(memory_budget=1, spill_dir=tmp_path)
+    fill(spilled, usage)
+    assert not in_memory.runs
+    assert len(spilled.runs) > 1
+
+    expected = in_memory.quantiles(PERCENTILES).sort_index()
+    actual = spilled.quantiles(PERCENTILES).sort_index()
+    pd.testing.assert_frame_equal(actual, expected)
+    assert not list(tmp_path.iterdir())
@@ -0,0 +1,91 @@
+import pytest
+
+import tool_matching
+
+TOOLSHED = "toolshed.g2.bx.psu.edu/repos"
+
+TOOLS = [
+    "default",
+    "cat1",
+    "upload1",
+    f"{TOOLSHED}/devteam/bwa/bwa/.*",
+    f"{TOOLSHED}/devteam/bwa/bwa_mem/.*",
+    f"{TOOLSHED}/iuc/fastp/fastp/0.20.1",
+    f"{TOOLSHED}/iuc/fastp/fastp/0.23.2",
+    f"{TOOLSHED}/iuc/fastp/fastp/0.23.2+galaxy1",
+    f"{TOOLSHED}/bgruening/hifiasm/hifiasm/0.19.8+galaxy0/.*",
+    f"{TOOLSHED}/iuc/kraken2/kraken2[^/]*/.*",
+    f"{TOOLSHED}/iuc/.*/multiqc/.*",
+]
+
+
+def linear_match(tool, tools):
+    """
+    How update-shared-db.py matched tools before ToolMatcher: the exact key, its
+    /.* key, or else the first key containing the tool id.
+    """
+    if tool in tools:
+        return tool
+    if tool + "/.*" in tools:
+        return tool + "/.*"
+    for key in tools:
+        if tool in key:
+            return key
+    return None
+
+
+@pytest.mark.parametrize(
+    "tool",
+    [
+        "cat1",
+        "upload1",
+        f"{TOOLSHED}/devteam/bwa/bwa",
+        f"{TOOLSHED}/devteam/bwa/bwa_mem",
+        f"{TOOLSHED}/iuc/fastp/fastp",
+        f"{TOOLSHED}/bgruening/hifiasm/hifiasm",
+        f"{TOOLSHED}/iuc/kraken2/kraken2",
+        f"{TOOLSHED}/iuc/unknown/unknown",
+        "unknown1",
+    ],
+)
+def test_matches_like_the_linear_search(tool):
+    match = tool_matching.ToolMatcher(TOOLS).match(tool)
+    assert (match.key if match else None) == linear_match(tool, TOOLS)
+
+
+def test_match_kinds():
+    matcher = tool_matching.ToolMatcher(TOOLS)
+    assert matcher.match("cat1").kind == tool_matching.EXACT
+    assert matcher.match(f"{TOOLSHED}/devteam/bwa/bwa").kind == tool_matching.ANY_VERSION
+    match = matcher.match(f"{TOOLSHED}/iuc/fastp/fastp")
+    assert match.kind == tool_matching.PREFIX
+    # Version keys of the same depth are ambiguous
+    assert match.alternatives == [f"{TOOLSHED}/iuc/fastp/fastp/0.23.2"]
+
+
+def test_prefix_matches_whole_segments_only():
+    # The linear search took any key containing the tool id, like bwa_mem's for bw
+    tools = [key for key in TOOLS if key != f"{TOOLSHED}/devteam/bwa/bwa/.*"]
+    tool = f"{TOOLSHED}/devteam/bwa/bw"
+    assert linear_match(tool, tools) == f"{TOOLSHED}/devteam/bwa/bwa_mem/.*"
+    assert tool_matching.ToolMatcher(tools).match(tool) is None
+
+
+def test_regex_keys_match_tools_they_cover():
+    matcher = tool_matching.ToolMatcher(TOOLS)
+    # Not found by the linear search, which only looked for substrings
+    for tool, key in [
+        (f"{TOOLSHED}/iuc/kraken2/kraken2_report", f"{TOOLSHED}/iuc/kraken2/kraken2[^/]*/.*"),
+        (f"{TOOLSHED}/iuc/multiqc_suite/multiqc", f"{TOOLSHED}/iuc/.*/multiqc/.*"),
+    ]:
+        assert linear_match(tool, TOOLS) is None
+        match = matcher.match(tool)
+        assert (match.key, match.kind) == (key, tool_matching.REGEX)
+
+
+def test_added_keys_are_matched():
+    matcher = tool_matching.ToolMatcher(TOOLS)
+    tool = f"{TOOLSHED}/iuc/unknown/unknown"
+    assert matcher.match(tool) is None
+    matcher.add(tool + "/.*")
+    assert matcher.match(tool).key == tool + "/.*"
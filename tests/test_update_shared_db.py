@@ -0,0 +1,123 @@
+import pandas as pd
+import pytest
+
+import aggregation
+import interchange
+import metrics
+import yaml_io
+
+# A resource query row, as returned for one region
+RESOURCE_ROW = {
+    "tpv_tool_name": "bwa",
+    "tool_name": "bwa",
+    "num_jobs": 10.0,
+    "avg_tpv_mem_gb": 16.0,
+    "max_tpv_mem_gb": 16.0,
+    "avg_tpv_cores": 4.0,
+    "max_tpv_cores": 4.0,
+    "avg_job_max_mem_gb": 8.0,
+    "max_job_max_mem_gb": 10.0,
+    "mem_wastage_avg_gb": 8.0,
+    "mem_wastage_min_gb": 6.0,
+    "mem_wastage_avg_percentage": 50.0,
+    "mem_wastage_min_percentage": 37.5,
+    "avg_allocated_cpu_seconds": 1000.0,
+    "max_allocated_cpu_seconds": 2000.0,
+    "avg_actual_cpu_seconds": 400.0,
+    "max_actual_cpu_seconds": 800.0,
+    "cpu_wastage_avg_seconds": 600.0,
+    "cpu_wastage_min_seconds": 500.0,
+    "cpu_wastage_avg_percentage": 60.0,
+    "cpu_wastage_min_percentage": 50.0,
+}
+
+
+@pytest.fixture
+def wastage_path(tmp_path):
+    # Two regions, as mem-optimize.py combines them
+    rows = pd.DataFrame([RESOURCE_ROW, dict(RESOURCE_ROW, mem_wastage_min_gb=7.0)])
+    path = str(tmp_path / "output.arrow")
+    interchange.write(path, aggregation.find_wastage(rows), {"window": 365})
+    return path
+
+
+def adjust(update_shared_db, shared_db, wastage_path):
+    tools, wastage = update_shared_db.load_wastage(wastage_path)
+    return update_shared_db.adjust_resources(shared_db, tools, wastage)
+
+
+def test_adjusts_numeric_entries(update_shared_db, wastage_path):
+    shared_db = {"tools": {"bwa/.*": {"mem": 16, "cores": 4}}}
+    adjust(update_shared_db, shared_db, wastage_path)
+    # 16 - 0.95 * 6 GB, and ceil(4 * (1 - 0.95 * 500 / 1000)) cores
+    assert shared_db["tools"]["bwa/.*"] == {"mem": 10.3, "cores": 3}
+
+
+def test_keeps_tpv_expressions(update_shared_db, wastage_path, tmp_path):
+    path = tmp_path / "tools.yml"
+    path.write_text("tools:\n  bwa/.*:\n    cores: 4\n    mem: cores * 4\n")
+    document = yaml_io.Document(str(path))
+    adjust(update_shared_db, document.data, wastage_path)
+    document.save()
+    assert path.read_text() == "tools:\n  bwa/.*:\n    cores: 3\n    mem: cores * 4\n"
+
+
+def test_fills_in_missing_entries(update_shared_db, wastage_path):
+    shared_db = {"tools": {"bwa/.*": {"cores": "{1 if input_size < 1 else 4}"}}}
+    adjust(update_shared_db, shared_db, wastage_path)
+    assert shared_db["tools"]["bwa/.*"] == {
+        "cores": "{1 if input_size < 1 else 4}",
+        "mem": 10.3,
+    }
+
+
+def test_applying_the_same_records_twice_is_a_no_op(update_shared_db, wastage_path):
+    shared_db = {"tools": {"bwa/.*": {"mem": 16, "cores": 4}}}
+    adjust(update_shared_db, shared_db, wastage_path)
+    adjusted = dict(shared_db["tools"]["bwa/.*"])
+    for _ in range(2):
+        adjust(update_shared_db, shared_db, wastage_path)
+        assert shared_db["tools"]["bwa/.*"] == adjusted
+
+
+def test_raised_allocations_are_cut_by_the_wastage(update_shared_db, wastage_path):
+    shared_db = {"tools": {"bwa/.*": {"mem": 32, "cores": 8}}}
+    adjust(update_shared_db, shared_db, wastage_path)
+    assert shared_db["tools"]["bwa/.*"] == {"mem": 26.3, "cores": 5}
+
+
+def test_batch_updates_every_target_and_counts_stages_once(
+    update_shared_db, wastage_path, tmp_path
+):
+    paths = []
+    for site in ["au", "eu", "us", "be"]:
+        path = tmp_path / f"{site}.yml"
+        path.write_text("tools:\n  bwa/.*:\n    cores: 4\n    mem: 16\n")
+        paths.append(str(path))
+    metrics.drain()
+    reports = update_shared_db.main_batch(paths, wastage_path, max_workers=4)
+    assert [report["tools_changed"] for report in reports] == [{"mem": 1, "cores": 1}] * 4
+    for path in paths:
+        assert yaml_io.load(path) == {"tools": {"bwa/.*": {"cores": 3, "mem": 10.3}}}
+
+    stage_counts = {}
+    for (stage, _), (count, _) in metrics.METRICS.timers.items():
+        stage_counts[stage] = stage_counts.get(stage, 0) + count
+    assert stage_counts["load_wastage"] == 1
+    assert stage_counts["load_yaml"] == 4
+    assert stage_counts["save"] == 4
+
+
+def test_unmatched_tools_without_proposals_get_no_entry(update_shared_db, tmp_path):
+    # Only CPU wastage, and no cores seen to start from
+    rows = pd.DataFrame(
+        [
+            dict(RESOURCE_ROW, tpv_tool_name="z", avg_tpv_cores=None, max_tpv_cores=None),
+            dict(RESOURCE_ROW, tpv_tool_name="y"),
+        ]
+    ).assign(mem_wastage_min_gb=0.0)
+    path = str(tmp_path / "output.arrow")
+    interchange.write(path, aggregation.find_wastage(rows), {"window": 365})
+    shared_db = {"tools": {"default": {"cores": 1}}}
+    adjust(update_shared_db, shared_db, path)
+    assert shared_db["tools"] == {"default": {"cores": 1}, "y": {"cores": 3}}
@@ -0,0 +1,121 @@
+import yaml_io
+
+TOOLS_YML = """\
+# TPV shared database
+global:
+  default_inherits: default
+
+tools:
+  default:
+    cores: 1
+    mem: 3.8  # GB
+  # Aligners
+  "toolshed.g2.bx.psu.edu/repos/devteam/bwa/bwa/.*":
+    cores: 8
+    mem: 30
+    env:
+      _JAVA_OPTIONS: -Xmx{int(mem)}G
+  'toolshed.g2.bx.psu.edu/repos/iuc/.*/fastp/.*': {cores: 2, mem: 7.6}
+  cat1:
+    mem: 1
+    rules:
+      - if: input_size >= 10
+        mem: 8
+"""
+
+
+def load(tmp_path, text=TOOLS_YML):
+    path = tmp_path / "tools.yml"
+    path.write_text(text)
+    return path, yaml_io.Document(str(path))
+
+
+def test_unchanged_document_is_kept_as_is(tmp_path):
+    path, document = load(tmp_path)
+    document.save()
+    assert path.read_text() == TOOLS_YML
+
+
+def test_changed_values_keep_comments_ordering_and_quoting(tmp_path):
+    path, document = load(tmp_path)
+    document.data["tools"]["default"]["mem"] = 2.5
+    document.data["tools"]["toolshed.g2.bx.psu.edu/repos/devteam/bwa/bwa/.*"]["cores"] = 4
+    document.save()
+    assert path.read_text() == TOOLS_YML.replace("mem: 3.8  # GB", "mem: 2.5  # GB").replace(
+        "    cores: 8\n", "    cores: 4\n"
+    )
+
+
+def test_flow_style_entries_are_rewritten_in_place(tmp_path):
+    path, document = load(tmp_path)
+    key = "toolshed.g2.bx.psu.edu/repos/iuc/.*/fastp/.*"
+    document.data["tools"][key]["mem"] = 3.8
+    document.save()
+    text = path.read_text()
+    assert yaml_io.load(str(path)) == document.data
+    # Only that entry changed, the lines around it are untouched
+    before, after = TOOLS_YML.split(f"  '{key}'")
+    assert text.startswith(before)
+    assert text.endswith(after.split("\n", 1)[1])
+
+
+def test_new_tools_and_fields_are_added_at_the_end(tmp_path):
+    path, document = load(tmp_path)
+    document.data["tools"]["cat1"]["cores"] = 2
+    document.data["tools"]["toolshed.g2.bx.psu.edu/repos/iuc/multiqc/multiqc/.*"] = {"mem": 7.6}
+    document.save()
+    assert yaml_io.load(str(path)) == document.data
+    text = path.read_text()
+    assert text.startswith(TOOLS_YML.split("      - if:")[0])
+    assert text.endswith(
+        "        mem: 8\n"
+        "    cores: 2\n"
+        "  toolshed.g2.bx.psu.edu/repos/iuc/multiqc/multiqc/.*:\n"
+        "    mem: 7.6\n"
+    )
+
+
+def test_other_changes_rewrite_the_whole_file(tmp_path):
+    path, document = load(tmp_path)
+    document.data["global"]["default_inherits"] = "base"
+    document.save()
+    assert yaml_io.load(str(path)) == document.data
+
+
+def test_crlf_line_endings_are_kept(tmp_path):
+    text = TOOLS_YML.replace("\n", "\r\n")
+    path = tmp_path / "tools.yml"
+    path.write_bytes(text.encode())
+    document = yaml_io.Document(str(path))
+    document.data["tools"]["default"]["mem"] = 2.5
+    document.data["tools"]["cat1"]["cores"] = 2
+    document.save()
+    expected = TOOLS_YML.replace("mem: 3.8  # GB", "mem: 2.5  # GB") + "    cores: 2\n"
+    assert path.read_bytes() == expected.replace("\n", "\r\n").encode()
+
+
+def test_entries_sharing_nodes_rewrite_the_whole_file(tmp_path):
+    path, document = load(
+        tmp_path,
+        "tools:\n"
+        "  a: &x\n"
+        "    mem: 4\n"
+        "  b: *x\n"
+        "  c:\n"
+        "    mem: 8\n",
+    )
+    assert document.shared_entries == {"a", "b"}
+    # Both keys load as the same dict, so changing one changes the other
+    document.data["tools"]["b"]["mem"] = 2
+    document.save()
+    assert yaml_io.load(str(path)) == {
+        "tools": {"a": {"mem": 2}, "b": {"mem": 2}, "c": {"mem": 8}}
+    }
+
+
+def test_entries_not_sharing_nodes_are_still_patched(tmp_path):
+    text = "tools:\n  a: &x\n    mem: 4\n  b: *x\n  # kept\n  c:\n    mem: 8\n"
+    path, document = load(tmp_path, text)
+    document.data["tools"]["c"]["mem"] = 6
+    document.save()
+    assert path.read_text() == text.replace("mem: 8", "mem: 6")
@@ -0,0 +1,124 @@
+import functools
+import re
+from collections import namedtuple
+
+# Characters that make a tools.yml key (or one of its path segments) a regex. Dots
+# are left out: TPV keys use them unescaped for literal dots in hostnames and versions.
+REGEX_CHARS = frozenset("*+?[](){}|^$\\")
+
+ANY_VERSION_SUFFIX = "/.*"
+
+# How a tool was matched, from most to least specific
+EXACT = "exact"
+ANY_VERSION = "any_version"
+PREFIX = "prefix"
+REGEX = "regex"
+
+ToolMatch = namedtuple("ToolMatch", ["key", "kind", "alternatives"])
+
+
+def is_regex(text):
+    return not REGEX_CHARS.isdisjoint(text)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_key(key):
+    try:
+        return re.compile(key)
+    except re.error:
+        return None
+
+
+def regex_matches(key, tool):
+    # Keys are only compiled when a lookup gets to them
+    pattern = compile_key(key)
+    return pattern is not None and pattern.fullmatch(tool) is not None
+
+
+class Node:
+    __slots__ = ("children", "regexes", "candidates")
+
+    def __init__(self):
+        self.children = {}
+        # Regex keys whose literal segments end here, in file order
+        self.regexes = []
+        # Best two (segments, order, key) of the keys below this node
+        self.candidates = []
+
+    def offer(self, candidate):
+        self.candidates = sorted(self.candidates + [candidate])[:2]
+
+
+class ToolMatcher:
+    """
+    Index of the keys of a tools.yml, built once and queried for each tool id in
+    roughly O(length of the tool id).
+
+    Keys are stored in a trie over their "/" separated segments, up to their first
+    regex segment. A tool id (without version) is matched, in order of preference,
+    by:
+
+    - the key equal to it,
+    - its ``/.*`` key, which covers every version,
+    - keys that extend it with more segments, such as rules for specific versions,
+      fewest segments first,
+    - regex keys that match it with any version.
+
+    Ties are broken by file order, and reported as alternatives.
+    """
+
+    def __init__(self, tools=()):
+        self.keys = set()
+        self.root = Node()
+        for key in tools:
+            self.add(key)
+
+    def add(self, key):
+        if key in self.keys:
+            return
+        order = len(self.keys)
+        self.keys.add(key)
+        segments = key.split("/")
+        candidate = (len(segments), order, key)
+
+        node = self.root
+        for segment in segments:
+            if is_regex(segment):
+                node.regexes.append(key)
+                node.offer(candidate)
+                return
+            node.offer(candidate)
+            node = node.children.setdefault(segment, Node())
+
+    def match(self, tool):
+        if tool in self.keys:
+            return ToolMatch(tool, EXACT, [])
+        if tool + ANY_VERSION_SUFFIX in self.keys:
+            return ToolMatch(tool + ANY_VERSION_SUFFIX, ANY_VERSION, [])
+
+        # Walk down the tool's segments, keeping the regex keys met on the way
+        path = [self.root]
+        for segment in tool.split("/"):
+            node = path[-1].children.get(segment)
+            if node is None:
+                break
+            path.append(node)
+        else:
+            candidates = path[-1].candidates
+            if candidates:
+                best = candidates[0]
+                alternatives = [
+                    key for segments, _, key in candidates[1:] if segments == best[0]
+                ]
+                return ToolMatch(best[2], PREFIX, alternatives)
+
+        # A regex key covers the tool if it matches the tool id with some version
+        for node in reversed(path):
+            matches = [
+                key
+                for key in node.regexes
+                if regex_matches(key, tool) or regex_matches(key, tool + "/")
+            ]
+            if matches:
+                return ToolMatch(matches[0], REGEX, matches[1:])
+        return None
@@ -1,10 +1,19 @@
 import argparse
+import concurrent.futures
+import json
 import logging
 import math
 import os
 import sys
 
-import yaml
+import numpy as np
+
+import aggregation
+import atomic_file
+import interchange
+import metrics
+import tool_matching
+import yaml_io
 
 # Configure logging to print to stdout
 log = logging.getLogger(__name__)
@@ -23,114 +32,416 @@ log.addHandler(handler)
 
 
 def load_yaml(file_path):
-    with open(file_path, "r") as file:
-        return yaml.safe_load(file)
+    return yaml_io.load(file_path)
 
 
-def save_yaml(data, file_path):
-    with open(file_path, "w") as file:
-        yaml.dump(data, file, default_flow_style=False)
+def find_matching_tool_in_shared_db(tool, matcher):
+    match = matcher.match(tool)
+    if match is None:
+        log.debug(f"Could not find tool: {tool} in shared db")
+        metrics.count("tools_unmatched")
+        return None
+    metrics.count("tools_matched", kind=match.kind)
+    if match.kind not in (tool_matching.EXACT, tool_matching.ANY_VERSION):
+        log.debug(f"Closest matching tool for tool: {tool} in shared db is: {match.key}")
+    if match.alternatives:
+        log.warning(
+            f"Ambiguous match for tool: {tool} in shared db, using: {match.key} over: {match.alternatives}"
+        )
+    return match.key
 
 
-def find_matching_tool_in_shared_db(tool, shared_db):
-    if tool in shared_db["tools"]:
-        return tool
-    elif (tool + "/.*") in shared_db["tools"]:
-        return tool + "/.*"
-    else:
-        for key in shared_db["tools"].keys():
-            if tool in key:
-                log.debug(
-                    f"Closest matching tool for tool: {tool} in shared db is: {key}"
-                )
-                return key
-    log.debug(f"Could not find tool: {tool} in shared db")
-    return None
+def float_column(records, key):
+    return np.fromiter(
+        (aggregation.to_float(record.get(key)) for record in records),
+        dtype=np.float64,
+        count=len(records),
+    )
 
 
-def get_proposed_mem(data, tool_entry, tool_name):
-    if "mem" in tool_entry:
-        tool_mem = tool_entry["mem"]
-    else:
-        log.debug(f"No mem entry for tool: {tool_name} in shared db. Setting mem")
-        tool_mem = float(data["max_tpv_mem_gb"])
-    wasted_mem = float(data["mem_wastage_min_gb"])
-    adjusted_mem = max(0, tool_mem - wasted_mem)
-    return round(adjusted_mem, 2)
+def is_expression(records, key):
+    """
+    Whether each record sets ``key`` to something other than a number, like a
+    TPV expression such as ``cores * 4``.
+    """
+    return np.fromiter(
+        (
+            record.get(key) is not None
+            and math.isnan(aggregation.to_float(record.get(key)))
+            for record in records
+        ),
+        dtype=bool,
+        count=len(records),
+    )
 
 
-def get_proposed_cores(data, tool_entry, tool_name):
-    if "cores" in tool_entry:
-        tool_cores = tool_entry["cores"]
-    else:
-        log.debug(f"No cores entry for tool: {tool_name} in shared db. Setting cores")
-        if "max_tpv_cores" in data:
-            tool_cores = float(data["avg_tpv_cores"])
-        else:
-            log.debug(f"No max_tpv_cores for: {tool_name} in shared db. Ignoring")
-            return None
-        # Compute fraction used (based on min wastage) and effective cores
-    allocated = float(data["avg_allocated_cpu_seconds"])
-    wastage = float(data["cpu_wastage_min_seconds"])
-    used_fraction_min = max(0.0, min(1.0, 1.0 - (wastage / allocated)))
-    effective_cores = tool_cores * used_fraction_min
-    return math.ceil(effective_cores)
-
-
-def adjust_resources(shared_db, resource_wastage_data):
-    for tool, data in resource_wastage_data.items():
-        found_tool = find_matching_tool_in_shared_db(tool, shared_db)
-        if found_tool:
-            tool_entry = shared_db["tools"][found_tool]
-            tool_name = found_tool
-        else:
-            tool_name = (tool + "/.*") if "toolshed" in tool else tool
-            tool_entry = {}
-            shared_db["tools"][tool_name] = tool_entry
+WASTAGE_KEYS = [
+    "max_tpv_mem_gb",
+    "mem_wastage_min_gb",
+    "avg_tpv_cores",
+    "avg_allocated_cpu_seconds",
+    "cpu_wastage_min_seconds",
+]
+
+
+def wastage_keys(mem_percentile=None):
+    if mem_percentile is None:
+        return WASTAGE_KEYS
+    return WASTAGE_KEYS + [f"job_max_mem_gb_p{mem_percentile:g}"]
+
+
+def wastage_columns(resource_wastage_data, mem_percentile=None):
+    """
+    The per-tool records of a YAML output as one array per field.
+    """
+    records = list(resource_wastage_data.values())
+    columns = {key: float_column(records, key) for key in wastage_keys(mem_percentile)}
+    columns["has_max_tpv_cores"] = ~np.isnan(float_column(records, "max_tpv_cores"))
+    return columns
+
+
+def load_wastage(resource_wastage_path, mem_percentile=None):
+    """
+    Tool names and per-field arrays of the wastage data, from mem-optimize.py's
+    Arrow output or from a YAML export.
+    """
+    if resource_wastage_path.endswith((".yaml", ".yml")):
+        resource_wastage_data = load_yaml(resource_wastage_path)
+        return list(resource_wastage_data), wastage_columns(
+            resource_wastage_data, mem_percentile
+        )
+
+    table, metadata = interchange.read(resource_wastage_path)
+    log.debug(
+        f"Loaded wastage data for {table.num_rows} tools, generated at {metadata.get('generated_at')} "
+        f"over {metadata.get('window')} days of regions: {metadata.get('regions')}"
+    )
+    if mem_percentile is not None and mem_percentile not in metadata.get(
+        "percentiles", []
+    ):
+        log.warning(f"No percentile: {mem_percentile:g} in {resource_wastage_path}")
+    columns = {
+        key: interchange.float_column(table, key)
+        for key in wastage_keys(mem_percentile)
+    }
+    columns["has_max_tpv_cores"] = ~np.isnan(
+        interchange.float_column(table, "max_tpv_cores")
+    )
+    return table.column(interchange.TOOL_COLUMN).to_pylist(), columns
+
+
+def get_proposed_mem(wastage, current_mem, mem_percentile=None):
+    """
+    Proposed mem for every tool, NaN where there is nothing to go on.
+    """
+    # Tools without a mem entry start from the largest allocation seen
+    basis = wastage["max_tpv_mem_gb"]
+    tool_mem = np.where(np.isnan(current_mem), basis, current_mem)
+    # The wastage was measured against the allocation the jobs had. Where mem is
+    # already below that, e.g. because the same records were applied before, only
+    # what is left of the wastage is taken off, so applying them again is a no-op
+    measured_against_current = np.isnan(basis) | (tool_mem >= basis)
+    adjusted_mem = np.where(
+        measured_against_current,
+        tool_mem - wastage["mem_wastage_min_gb"],
+        np.fmin(tool_mem, basis - wastage["mem_wastage_min_gb"]),
+    )
+    if mem_percentile is not None:
+        # Size to the given percentile of observed memory, but never raise it
+        observed = wastage[f"job_max_mem_gb_p{mem_percentile:g}"]
+        adjusted_mem = np.where(
+            np.isnan(observed), adjusted_mem, np.fmin(tool_mem, observed)
+        )
+    return np.round(np.maximum(adjusted_mem, 0), 2)
+
+
+def get_proposed_cores(wastage, current_cores):
+    """
+    Proposed cores for every tool, NaN where there is nothing to go on.
+    """
+    # Tools without a cores entry start from the average allocation seen, if known
+    basis = np.where(wastage["has_max_tpv_cores"], wastage["avg_tpv_cores"], np.nan)
+    tool_cores = np.where(np.isnan(current_cores), basis, current_cores)
+    # Compute fraction used (based on min wastage) and effective cores. Tools
+    # without CPU data keep their cores.
+    allocated = wastage["avg_allocated_cpu_seconds"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        used_fraction_min = np.where(
+            allocated > 0, 1.0 - wastage["cpu_wastage_min_seconds"] / allocated, np.nan
+        )
+    used_fraction_min = np.clip(np.nan_to_num(used_fraction_min, nan=1.0), 0.0, 1.0)
+    # Like for mem, cores already cut below the measured allocation aren't cut again
+    measured_against_current = np.isnan(basis) | (tool_cores >= basis)
+    return np.ceil(
+        np.where(
+            measured_against_current,
+            tool_cores * used_fraction_min,
+            np.fmin(tool_cores, basis * used_fraction_min),
+        )
+    )
 
-        # adjust resources
-        tool_entry["mem"] = get_proposed_mem(data, tool_entry, tool_name)
-        tool_entry["cores"] = get_proposed_cores(data, tool_entry, tool_name)
+
+def adjust_resources(shared_db, tools, wastage, mem_percentile=None):
+    with metrics.stage("match"):
+        matcher = tool_matching.ToolMatcher(shared_db["tools"])
+        tool_names = []
+        for tool in tools:
+            found_tool = find_matching_tool_in_shared_db(tool, matcher)
+            if found_tool:
+                tool_name = found_tool
+            else:
+                # Only added to tools.yml once there's something to set, but
+                # matched by later tools already
+                tool_name = (tool + "/.*") if "toolshed" in tool else tool
+                matcher.add(tool_name)
+            tool_names.append(tool_name)
+
+    # Line up the entries with the wastage records, and compute all proposals at once
+    entries = [shared_db["tools"].get(tool_name) or {} for tool_name in tool_names]
+    current_mem = float_column(entries, "mem")
+    current_cores = float_column(entries, "cores")
+    with metrics.stage("propose"):
+        proposed_mem = get_proposed_mem(wastage, current_mem, mem_percentile)
+        proposed_cores = get_proposed_cores(wastage, current_cores)
+    log.debug(
+        f"No mem entry for {int(np.isnan(current_mem).sum())} tools and no cores entry for "
+        f"{int(np.isnan(current_cores).sum())} tools in shared db"
+    )
+
+    # Write back only what changed, and never overwrite TPV expressions
+    mem_changed = (
+        ~np.isnan(proposed_mem)
+        & (proposed_mem != current_mem)
+        & ~is_expression(entries, "mem")
+    )
+    cores_changed = (
+        ~np.isnan(proposed_cores)
+        & (proposed_cores != current_cores)
+        & ~is_expression(entries, "cores")
+    )
+    for index in np.flatnonzero(mem_changed | cores_changed):
+        tool_entry = shared_db["tools"].get(tool_names[index])
+        if tool_entry is None:
+            if tool_names[index] not in shared_db["tools"]:
+                metrics.count("tools_created")
+            tool_entry = shared_db["tools"][tool_names[index]] = {}
+        if mem_changed[index]:
+            tool_entry["mem"] = float(proposed_mem[index])
+        if cores_changed[index]:
+            tool_entry["cores"] = int(proposed_cores[index])
+    metrics.count("tools_changed", int(mem_changed.sum()), field="mem")
+    metrics.count("tools_changed", int(cores_changed.sum()), field="cores")
+    log.debug(
+        f"Adjusted mem of {int(mem_changed.sum())} and cores of {int(cores_changed.sum())} tools"
+    )
 
     return shared_db
 
 
-def main(tpv_shared_db_path, resource_wastage_path):
-    # Load the shared database YAML file
-    shared_db = load_yaml(tpv_shared_db_path)
+def main(tpv_shared_db_path, resource_wastage_path, mem_percentile=None):
+    # Load the shared database YAML file, keeping track of where each tool is
+    with metrics.stage("load_yaml"):
+        document = yaml_io.Document(tpv_shared_db_path)
+    shared_db = document.data
 
-    # Load the resource wastage output YAML file
-    resource_wastage_data = load_yaml(resource_wastage_path)
+    # Load the resource wastage output of mem-optimize.py
+    with metrics.stage("load_wastage"):
+        tools, wastage = load_wastage(resource_wastage_path, mem_percentile)
 
     # Adjust resources in the shared database
-    updated_shared_db = adjust_resources(shared_db, resource_wastage_data)
+    adjust_resources(shared_db, tools, wastage, mem_percentile)
 
-    # Save the updated shared database back to the file
-    save_yaml(updated_shared_db, tpv_shared_db_path)
+    # Save the updated shared database back to the file, rewriting only the
+    # tools that changed
+    with metrics.stage("save"):
+        document.save()
     print(f"Updated shared database saved to {tpv_shared_db_path}")
 
 
+# Batch mode: the wastage data is loaded once and handed to a pool of worker
+# processes, each of which updates one tools.yml at a time.
+ALLOCATION_FIELDS = ["mem", "cores"]
+
+# The tools, wastage arrays and mem percentile of a worker process
+worker_wastage = None
+
+
+def init_worker(tools, wastage, mem_percentile, metrics_jsonl=None):
+    global worker_wastage
+    worker_wastage = (tools, wastage, mem_percentile)
+    # Forked workers start with a copy of the parent's metrics, which the parent
+    # already has: only what the worker records itself is merged back
+    metrics.drain()
+    metrics.configure(metrics_jsonl)
+
+
+def allocations(shared_db):
+    return {
+        tool_name: {field: (entry or {}).get(field) for field in ALLOCATION_FIELDS}
+        for tool_name, entry in shared_db["tools"].items()
+    }
+
+
+def allocation_changes(before, after):
+    changes = []
+    for tool_name, values in after.items():
+        previous = before.get(tool_name, {})
+        for field, value in values.items():
+            if value != previous.get(field):
+                changes.append(
+                    {"tool": tool_name, "field": field, "old": previous.get(field), "new": value}
+                )
+    return changes
+
+
+def update_target(tpv_shared_db_path):
+    """
+    Update one tools.yml with the wastage data of the worker. Returns its change
+    report and the metrics recorded meanwhile.
+    """
+    tools, wastage, mem_percentile = worker_wastage
+    report = {"target": tpv_shared_db_path}
+    with metrics.labels(target=tpv_shared_db_path):
+        try:
+            with metrics.stage("load_yaml"):
+                document = yaml_io.Document(tpv_shared_db_path)
+            before = allocations(document.data)
+            adjust_resources(document.data, tools, wastage, mem_percentile)
+            changes = allocation_changes(before, allocations(document.data))
+            with metrics.stage("save"):
+                document.save()
+        except Exception as e:
+            log.error(f"Failed to update {tpv_shared_db_path}: {e.__class__.__name__}: {e}")
+            metrics.count("targets_failed")
+            report["error"] = f"{e.__class__.__name__}: {e}"
+        else:
+            report.update(
+                tools_created=len(set(document.data["tools"]) - set(before)),
+                tools_changed={
+                    field: sum(change["field"] == field for change in changes)
+                    for field in ALLOCATION_FIELDS
+                },
+                changes=changes,
+            )
+    return report, metrics.drain()
+
+
+def main_batch(
+    tpv_shared_db_paths,
+    resource_wastage_path,
+    mem_percentile=None,
+    max_workers=None,
+    report_path=None,
+    metrics_jsonl=None,
+):
+    """
+    Update every tools.yml in ``tpv_shared_db_paths`` in parallel. Writes the
+    change report of every target to ``report_path`` and returns the reports.
+    """
+    with metrics.stage("load_wastage"):
+        tools, wastage = load_wastage(resource_wastage_path, mem_percentile)
+
+    reports = []
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(max_workers or os.cpu_count() or 1, len(tpv_shared_db_paths)),
+        initializer=init_worker,
+        initargs=(tools, wastage, mem_percentile, metrics_jsonl),
+    ) as executor:
+        for report, drained in executor.map(update_target, tpv_shared_db_paths):
+            metrics.merge(drained)
+            reports.append(report)
+            if "error" in report:
+                continue
+            print(
+                f"Updated shared database saved to {report['target']}: mem of "
+                f"{report['tools_changed']['mem']} and cores of {report['tools_changed']['cores']} "
+                f"tools changed, {report['tools_created']} tools added"
+            )
+
+    if report_path:
+        atomic_file.write_text(
+            report_path,
+            json.dumps(
+                {"wastage": resource_wastage_path, "targets": reports},
+                indent=2,
+                default=str,
+            )
+            + "\n",
+        )
+        log.debug(f"Change report written to {report_path}")
+    return reports
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Update the TPV shared database YAML file with adjusted memory values."
     )
     parser.add_argument(
-        "tpv_shared_db_path", type=str, help="Path to the TPV shared database YAML file"
+        "tpv_shared_db_paths",
+        metavar="tpv_shared_db_path",
+        type=str,
+        nargs="+",
+        help="Path to the TPV shared database YAML file. Several files, e.g. the databases of "
+        "several sites, are updated in parallel",
     )
     parser.add_argument(
         "resource_wastage_path",
         type=str,
-        help="Path to the resource wastage output YAML file",
+        help="Path to the resource wastage output of mem-optimize.py (.arrow, or a .yaml export)",
+    )
+    parser.add_argument(
+        "--mem-percentile",
+        type=float,
+        default=None,
+        help="Size memory to this percentile of observed job memory instead of subtracting the minimum wastage. "
+        "Requires mem-optimize.py to have been run with the same value in --percentiles",
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of files to update at a time when given several, the number of CPUs by default",
+    )
+    parser.add_argument(
+        "--report",
+        help="Write what changed in each file to this JSON file",
+    )
+
+    parser.add_argument(
+        "--metrics-jsonl",
+        help="Append stage timings and counters (tools matched, created, changed, ...) to this file as JSON lines",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Write the totals of the stage timings and counters to this OpenMetrics text file when done",
     )
 
     args = parser.parse_args()
 
-    if not os.path.exists(args.tpv_shared_db_path):
-        print(f"Error: The file {args.tpv_shared_db_path} does not exist.")
-        exit(1)
+    for tpv_shared_db_path in args.tpv_shared_db_paths:
+        if not os.path.exists(tpv_shared_db_path):
+            print(f"Error: The file {tpv_shared_db_path} does not exist.")
+            exit(1)
 
     if not os.path.exists(args.resource_wastage_path):
         print(f"Error: The file {args.resource_wastage_path} does not exist.")
         exit(1)
 
-    main(args.tpv_shared_db_path, args.resource_wastage_path)
+    metrics.configure(args.metrics_jsonl)
+    failed = False
+    if len(args.tpv_shared_db_paths) == 1 and not args.report:
+        main(args.tpv_shared_db_paths[0], args.resource_wastage_path, args.mem_percentile)
+    else:
+        reports = main_batch(
+            args.tpv_shared_db_paths,
+            args.resource_wastage_path,
+            args.mem_percentile,
+            args.jobs,
+            args.report,
+            args.metrics_jsonl,
+        )
+        failed = any("error" in report for report in reports)
+    if args.metrics_file:
+        metrics.write_openmetrics(args.metrics_file)
+    if failed:
+        exit(1)
@@ -0,0 +1,256 @@
+import copy
+import re
+
+import yaml
+
+import atomic_file
+
+# Use libyaml when PyYAML was built with it, it's several times faster
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+
+def load(file_path):
+    with open(file_path, "r") as file:
+        return yaml.load(file, Loader=Loader)
+
+
+def dumps(data):
+    return yaml.dump(data, Dumper=Dumper, default_flow_style=False)
+
+
+def dump(data, file_path):
+    atomic_file.write_text(file_path, dumps(data))
+
+
+def dump_scalar(value):
+    # Keep the scalar on one line
+    text = yaml.dump(value, Dumper=Dumper, width=10**9)
+    return text.rstrip("\n").removesuffix("\n...")
+
+
+def is_block(node):
+    return isinstance(node, (yaml.MappingNode, yaml.SequenceNode)) and not node.flow_style
+
+
+def last_line(node):
+    """
+    Last line holding any of ``node``'s content.
+    """
+    if is_block(node) and node.value:
+        child = node.value[-1]
+        return last_line(child[1] if isinstance(node, yaml.MappingNode) else child)
+    end = node.end_mark
+    # Block scalars end at the start of the line after them
+    if end.column == 0 and end.line > node.start_mark.line:
+        return end.line - 1
+    return end.line
+
+
+def indent(text, prefix):
+    return "".join(prefix + line for line in text.splitlines(keepends=True))
+
+
+# Line breaks as YAML counts them, for lines to line up with node marks
+LINE_BREAK = re.compile("\r\n|[\r\n\x85\u2028\u2029]")
+
+
+def split_lines(text):
+    lines = []
+    start = 0
+    for match in LINE_BREAK.finditer(text):
+        lines.append(text[start : match.end()])
+        start = match.end()
+    if start < len(text):
+        lines.append(text[start:])
+    return lines
+
+
+def shared_nodes(root):
+    """
+    Ids of the nodes reachable more than once from ``root``, i.e. anchored nodes
+    that are referred to by an alias (or merge key).
+    """
+    seen = set()
+    shared = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            shared.add(id(node))
+            continue
+        seen.add(id(node))
+        if isinstance(node, yaml.MappingNode):
+            stack.extend(child for pair in node.value for child in pair)
+        elif isinstance(node, yaml.SequenceNode):
+            stack.extend(node.value)
+    return shared
+
+
+def node_ids(node):
+    ids = set()
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if id(node) in ids:
+            continue
+        ids.add(id(node))
+        if isinstance(node, yaml.MappingNode):
+            stack.extend(child for pair in node.value for child in pair)
+        elif isinstance(node, yaml.SequenceNode):
+            stack.extend(node.value)
+    return ids
+
+
+class Document:
+    """
+    A YAML file with a top-level mapping ``section`` (like tools.yml's ``tools``)
+    that can be saved by patching just the entries of that section that changed.
+    Everything else, including comments, ordering and line endings, is kept as it
+    was. Any other kind of change, or a change to an entry that shares nodes with
+    others through anchors and aliases, falls back to rewriting the whole file.
+    """
+
+    def __init__(self, file_path, section="tools"):
+        self.file_path = file_path
+        self.section = section
+        with open(file_path, "r", newline="") as file:
+            self.text = file.read()
+        first_break = LINE_BREAK.search(self.text)
+        self.newline = first_break.group() if first_break else "\n"
+        loader = Loader(self.text)
+        try:
+            self.node = loader.get_single_node()
+            self.data = loader.construct_document(self.node) if self.node else None
+        finally:
+            loader.dispose()
+        self.original = copy.deepcopy(self.data)
+        self.entries = self.section_entries()
+        # Patching an entry that shares nodes would also change the others
+        self.shared_entries = set()
+        if self.entries:
+            shared = shared_nodes(self.node)
+            self.shared_entries = {
+                key
+                for key, (_, value_node) in self.entries.items()
+                if not shared.isdisjoint(node_ids(value_node))
+            }
+
+    def section_entries(self):
+        """
+        The key and value nodes of each entry of the section, by key.
+        """
+        if not isinstance(self.node, yaml.MappingNode) or not isinstance(
+            self.data, dict
+        ):
+            return None
+        for key_node, value_node in self.node.value:
+            if key_node.value == self.section:
+                if not is_block(value_node) or not isinstance(
+                    value_node, yaml.MappingNode
+                ):
+                    return None
+                keys = list(self.data.get(self.section) or {})
+                # Duplicate keys would leave nodes without an entry
+                if len(keys) != len(value_node.value):
+                    return None
+                self.section_node = value_node
+                return dict(zip(keys, value_node.value))
+        return None
+
+    def edits(self):
+        """
+        (line, column, end line, end column, text) edits turning the original text
+        into the current data, or None when the change can't be made as a patch.
+        Insertions at the same position are listed in the order they go in.
+        """
+        if self.entries is None or not self.entries:
+            return None
+        current = self.data.get(self.section)
+        original = self.original[self.section]
+        if not isinstance(current, dict):
+            return None
+        others = {key: value for key, value in self.data.items() if key != self.section}
+        if others != {k: v for k, v in self.original.items() if k != self.section}:
+            return None
+        if any(key not in current for key in original):
+            return None
+
+        edits = []
+        first_key = self.section_node.value[0][0]
+        entry_indent = " " * first_key.start_mark.column
+        appended = []
+        for key, entry in current.items():
+            if key not in original:
+                appended.append(indent(dumps({key: entry}), entry_indent))
+            elif entry != original[key]:
+                if key in self.shared_entries:
+                    return None
+                edits.extend(self.entry_edits(key, entry, entry_indent))
+        if appended:
+            line = last_line(self.section_node) + 1
+            edits.append((line, 0, line, 0, "".join(appended)))
+        return edits
+
+    def entry_edits(self, key, entry, entry_indent):
+        key_node, value_node = self.entries[key]
+        original = self.original[self.section][key]
+        if (
+            isinstance(entry, dict)
+            and isinstance(original, dict)
+            and isinstance(value_node, yaml.MappingNode)
+            and is_block(value_node)
+            and len(value_node.value) == len(original)
+            and all(field in entry for field in original)
+        ):
+            # Only rewrite the scalar fields that changed, and add new ones
+            fields = dict(zip(original, (node for _, node in value_node.value)))
+            field_indent = " " * value_node.value[0][0].start_mark.column
+            edits = []
+            added = []
+            for field, value in entry.items():
+                if field not in original:
+                    added.append(indent(dumps({field: value}), field_indent))
+                elif value != original[field]:
+                    node = fields.get(field)
+                    if not isinstance(node, yaml.ScalarNode) or isinstance(
+                        value, (dict, list)
+                    ):
+                        break
+                    start, end = node.start_mark, node.end_mark
+                    if start.line != end.line:
+                        break
+                    edits.append(
+                        (start.line, start.column, end.line, end.column, dump_scalar(value))
+                    )
+            else:
+                if added:
+                    line = last_line(value_node) + 1
+                    edits.append((line, 0, line, 0, "".join(added)))
+                return edits
+
+        # Otherwise re-emit the whole entry
+        start = key_node.start_mark
+        line = last_line(value_node) + 1
+        text = indent(dumps({key: entry}), entry_indent)[len(entry_indent) :]
+        return [(start.line, start.column, line, 0, text)]
+
+    def dumps(self):
+        edits = self.edits()
+        if edits is None:
+            return dumps(self.data).replace("\n", self.newline)
+        lines = split_lines(self.text)
+        if lines and not LINE_BREAK.search(lines[-1]):
+            lines[-1] += self.newline
+        # Apply from the end of the file so that earlier positions stay valid
+        order = sorted(
+            range(len(edits)), key=lambda i: (edits[i][0], edits[i][1], i), reverse=True
+        )
+        for line, column, end_line, end_column, text in (edits[i] for i in order):
+            head = lines[line][:column] if line < len(lines) else ""
+            tail = lines[end_line][end_column:] if end_line < len(lines) else ""
+            lines[line : end_line + 1] = [head + text.replace("\n", self.newline) + tail]
+        return "".join(lines)
+
+    def save(self, file_path=None):
+        atomic_file.write_text(file_path or self.file_path, self.dumps())